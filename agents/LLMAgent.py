@@ -1,13 +1,26 @@
+import asyncio
+import inspect
 import json
+import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
-from core.constants import LLMConstants
-from core.utils import LOGGER, llm_request
+from core.constants import ExecutionConstants, LLMConstants
+from core.utils import LOGGER, allm_request, llm_request
 
 
 class LLMAgent:
     def __init__(
-        self, name, role, examples="", tools=[], model=LLMConstants.GPT_MODEL, depth=1
+        self,
+        name,
+        role,
+        examples="",
+        tools=[],
+        model=LLMConstants.GPT_MODEL,
+        depth=1,
+        max_tool_workers=ExecutionConstants.MAX_TOOL_WORKERS,
+        tool_timeout=ExecutionConstants.TOOL_TIMEOUT,
     ):
         self.name = name
         self.role = role
@@ -17,6 +30,9 @@ class LLMAgent:
 
         self.depth = depth
 
+        self.max_tool_workers = max_tool_workers
+        self.tool_timeout = tool_timeout
+
         self.system_prompt = role
 
         if tools and len(tools) > 0:
@@ -47,15 +63,36 @@ class LLMAgent:
         for choice in response.choices:
             if choice.finish_reason in ["tool_calls", "function_call"]:
                 results.append(self.exec_func(choice))
-            elif choice.finish_reason == "stop":
-                results.append((choice.message.content))
-            elif choice.finish_reason == "content_filter":
-                raise Exception("Content filter triggered.")
-            elif choice.finish_reason == "length":
-                raise Exception("Max token length reached.")
             else:
-                raise Exception(f"Unknown finish reason: {choice.finish_reason}")
+                results.append(self._choice_content(choice))
+
+        return self._append_results(results)
+
+    async def arequest(self, prompt):
+        self.messages.append({"role": "user", "content": prompt})
 
+        response = await allm_request(self.messages, self.tools, self.model)
+
+        results = []
+        for choice in response.choices:
+            if choice.finish_reason in ["tool_calls", "function_call"]:
+                results.append(await self.aexec_func(choice))
+            else:
+                results.append(self._choice_content(choice))
+
+        return self._append_results(results)
+
+    def _choice_content(self, choice):
+        if choice.finish_reason == "stop":
+            return choice.message.content
+        elif choice.finish_reason == "content_filter":
+            raise Exception("Content filter triggered.")
+        elif choice.finish_reason == "length":
+            raise Exception("Max token length reached.")
+        else:
+            raise Exception(f"Unknown finish reason: {choice.finish_reason}")
+
+    def _append_results(self, results):
         results = "\n".join(results)
 
         self.messages.append({"role": "assistant", "content": results})
@@ -63,81 +100,199 @@ class LLMAgent:
         return results
 
     def exec_func(self, response_choice):
-        results = []
+        calls = self._parse_tool_calls(response_choice)
+
+        # Calls with malformed arguments are reported back in place, the others are executed
+        results = self.exec_tool_calls([call for call in calls if call[1] is not None])
+
+        return self._join_results(calls, results)
+
+    async def aexec_func(self, response_choice):
+        calls = self._parse_tool_calls(response_choice)
+
+        results = await self.aexec_tool_calls(
+            [call for call in calls if call[1] is not None]
+        )
+
+        return self._join_results(calls, results)
+
+    def _join_results(self, calls, results):
+        results = iter(results)
+
+        return "\n".join(
+            (
+                next(results)
+                if arguments is not None
+                else self._malformed_call_result(function_name)
+            )
+            for function_name, arguments in calls
+        )
+
+    def _parse_tool_calls(self, response_choice):
+        """
+        Return the (function name, arguments) of every tool call, arguments None when malformed.
+        """
+        calls = []
 
         if response_choice.finish_reason == "tool_calls":
-            tool_calls = response_choice.message.tool_calls
-            for tool_call in tool_calls:
+            for tool_call in response_choice.message.tool_calls:
                 LOGGER.log_with_depth(f"[Action] Function calling...", depth=self.depth)
 
+                function_name = tool_call.function.name
                 try:
-                    function_name = tool_call.function.name
-                    arguments = tool_call.function.arguments
-                    arguments = json.loads(arguments)
+                    arguments = json.loads(tool_call.function.arguments)
 
                     if function_name == "multi_tool_use.parallel":
-                        for sub_function in arguments["tool_uses"]:
-                            sub_function_name = sub_function["recipient_name"].split(
-                                "."
-                            )[-1]
-                            sub_arguments = sub_function["parameters"]
-
-                            result = eval(
-                                f"self.{sub_function_name}(**{sub_arguments})"
+                        sub_calls = [
+                            (
+                                sub_function["recipient_name"].split(".")[-1],
+                                sub_function["parameters"],
                             )
-
-                            if result is None:
-                                results.append(
-                                    f"<function>{sub_function_name}</function><result>NONE</result>"
-                                )
-                            else:
-                                results.append(
-                                    f"<function>{sub_function_name}</function><result>{result}</result>"
-                                )
-
-                            # Agent Level results
-                            if self.depth <= 1:
-                                LOGGER.log_with_depth(
-                                    f"<function>{sub_function_name}</function><result>{result}</result>",
-                                    depth=self.depth,
-                                )
+                            for sub_function in arguments["tool_uses"]
+                        ]
                     else:
-                        result = eval(f"self.{function_name}(**{arguments})")
-
-                        if result is None:
-                            results.append(
-                                f"<function>{function_name}</function><result>NONE</result>"
-                            )
-                        else:
-                            results.append(
-                                f"<function>{function_name}</function><result>{result}</result>"
-                            )
-
-                        # Agent Level results
-                        if self.depth <= 1:
-                            LOGGER.log_with_depth(
-                                f"<function>{function_name}</function><result>{result}</result>",
-                                depth=self.depth,
-                            )
-
-                except AttributeError as e:
+                        sub_calls = [(function_name, arguments)]
+                except (ValueError, KeyError, TypeError) as e:
                     LOGGER.log_with_depth(
-                        f"Function name: {function_name}, Arguments: {arguments}",
+                        f"Function name: {function_name}, Arguments: {tool_call.function.arguments}",
                         depth=self.depth,
                     )
                     LOGGER.log_with_depth(f"Warning: {e}", depth=self.depth)
-                    traceback.print_exc()
-                    results.append(
-                        f"[Function]: {function_name} is called and the result is None"
-                    )
-                except Exception as e:
-                    LOGGER.log_with_depth(function_name, depth=self.depth)
-                    LOGGER.log_with_depth(arguments, depth=self.depth)
-                    traceback.print_exc()
-                    raise Exception(
-                        f"Error executing function {function_name}, Arguments: {arguments}: {e}"
-                    )
+                    sub_calls = [(function_name, None)]
+
+                calls.extend(sub_calls)
+
+        return calls
+
+    def _malformed_call_result(self, function_name):
+        return f"<function>{function_name}</function><result>ERROR: the arguments could not be parsed</result>"
+
+    def exec_tool_calls(self, calls):
+        """
+        Dispatch every requested tool call concurrently and return their formatted results in call order.
+        """
+        if len(calls) == 0:
+            return []
+
+        pool = ThreadPoolExecutor(max_workers=min(self.max_tool_workers, len(calls)))
+        try:
+            futures = [
+                pool.submit(self._call_tool, function_name, arguments)
+                for function_name, arguments in calls
+            ]
+            deadline = time.monotonic() + self.tool_timeout
+
+            return [
+                self._collect_tool_result(future, function_name, arguments, deadline)
+                for future, (function_name, arguments) in zip(futures, calls)
+            ]
+        finally:
+            # Do not block on tool calls that already timed out
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    async def aexec_tool_calls(self, calls):
+        """
+        Async counterpart of exec_tool_calls.
+
+        A tool with an async variant, a method named a<tool name>, is awaited on the event loop.
+        Other tools are blocking and run in threads. At most max_tool_workers calls run at once.
+        """
+        if len(calls) == 0:
+            return []
+
+        workers = asyncio.Semaphore(self.max_tool_workers)
+
+        async def bounded_call(function_name, arguments):
+            async with workers:
+                return await self._acall_tool(function_name, arguments)
+
+        # Like the sync path, time spent waiting for a worker counts against the timeout
+        outcomes = await asyncio.gather(
+            *[
+                asyncio.wait_for(
+                    bounded_call(function_name, arguments), self.tool_timeout
+                )
+                for function_name, arguments in calls
+            ],
+            return_exceptions=True,
+        )
+
+        return [
+            (
+                self._tool_error(function_name, arguments, outcome)
+                if isinstance(outcome, BaseException)
+                else self._format_tool_result(function_name, outcome)
+            )
+            for outcome, (function_name, arguments) in zip(outcomes, calls)
+        ]
 
-                break
+    def _tool_names(self):
+        return {func["function"]["name"] for func in self.tools or []}
+
+    def _call_tool(self, function_name, arguments):
+        # Only declared tools are callable, not any method the model names
+        if function_name not in self._tool_names():
+            raise AttributeError(f"{self.name} has no tool named {function_name}")
+
+        return getattr(self, function_name)(**arguments)
+
+    async def _acall_tool(self, function_name, arguments):
+        async_tool = getattr(self, f"a{function_name}", None)
+
+        if function_name in self._tool_names() and inspect.iscoroutinefunction(
+            async_tool
+        ):
+            return await async_tool(**arguments)
+
+        return await asyncio.to_thread(self._call_tool, function_name, arguments)
+
+    def _collect_tool_result(self, future, function_name, arguments, deadline):
+        try:
+            result = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except Exception as e:
+            return self._tool_error(function_name, arguments, e)
+
+        return self._format_tool_result(function_name, result)
+
+    def _tool_error(self, function_name, arguments, e):
+        """
+        Return the result reported for a failed tool call, re-raise errors that are not tool errors.
+        """
+        if isinstance(e, (FuturesTimeoutError, asyncio.TimeoutError)):
+            LOGGER.log_with_depth(
+                f"Warning: {function_name} timed out after {self.tool_timeout}s, Arguments: {arguments}",
+                depth=self.depth,
+            )
+            return f"<function>{function_name}</function><result>TIMEOUT</result>"
+        elif isinstance(e, AttributeError):
+            LOGGER.log_with_depth(
+                f"Function name: {function_name}, Arguments: {arguments}",
+                depth=self.depth,
+            )
+            LOGGER.log_with_depth(f"Warning: {e}", depth=self.depth)
+            traceback.print_exception(e)
+            return f"[Function]: {function_name} is called and the result is None"
+        else:
+            LOGGER.log_with_depth(function_name, depth=self.depth)
+            LOGGER.log_with_depth(arguments, depth=self.depth)
+            traceback.print_exception(e)
+            raise Exception(
+                f"Error executing function {function_name}, Arguments: {arguments}: {e}"
+            ) from e
+
+    def _format_tool_result(self, function_name, result):
+        if result is None:
+            result_str = f"<function>{function_name}</function><result>NONE</result>"
+        else:
+            result_str = (
+                f"<function>{function_name}</function><result>{result}</result>"
+            )
+
+        # Agent Level results
+        if self.depth <= 1:
+            LOGGER.log_with_depth(
+                f"<function>{function_name}</function><result>{result}</result>",
+                depth=self.depth,
+            )
 
-        return "\n".join(results)
+        return result_str
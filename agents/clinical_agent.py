@@ -1,14 +1,25 @@
-import re
-
 from core.utils import LOGGER
 
 from .efficiency_agent import EfficiencyAgent
 from .enrollment_agent import EnrollmentAgent
 from .graph_reasoning_agent import GraphReasoningAgent
 from .LLMAgent import LLMAgent
-from .planning_agent import decomposition
+from .planning_agent import PLAN_CACHE, aplan_subproblems, plan_subproblems
 from .safety_agent import SafetyAgent
 
+SAFETY_QUESTION = (
+    "How can I evaluate the safety of the drug {drug_name} and disease {disease_name}?"
+)
+EFFICIENCY_QUESTION = "How can I evaluate the efficiency of the drug {drug_name} on the disease {disease_name}?"
+
+
+def precompute_plans():
+    """
+    Decompose the specialist questions once, so that no specialist invocation waits on a decomposition.
+    """
+    PLAN_CACHE.build_plan(SAFETY_QUESTION, tools=SafetyAgent().tools)
+    PLAN_CACHE.build_plan(EFFICIENCY_QUESTION, tools=EfficiencyAgent().tools)
+
 
 class ClinicalAgent(LLMAgent):
     def __init__(self, user_prompt, depth=1):
@@ -122,128 +133,123 @@ class ClinicalAgent(LLMAgent):
 
         super().__init__(self.name, self.role, tools=self.tools, depth=depth)
 
-    def safety_agent(self, drug_name, disease_name):
+    def _log_specialist(self, title):
         LOGGER.log_with_depth(f"", depth=1)
-        LOGGER.log_with_depth(f"Safety Agent...", depth=1)
+        LOGGER.log_with_depth(f"{title}...", depth=1)
         LOGGER.log_with_depth(f"Planing...", depth=1)
         LOGGER.log_with_depth(
             f"[Thought] Least to Most Reasoning: Decompose the original problem",
             depth=1,
         )
 
-        safety_agent_ins = SafetyAgent(depth=2)
-
-        decomposed_resp = decomposition(
-            f"How can I evaluate the safety of the drug {drug_name} and disease {disease_name}?",
-            tools=safety_agent_ins.tools,
-        )
-
-        subproblems = re.findall(r"<subproblem>(.*?)</subproblem>", decomposed_resp)
-        subproblems = [subproblem.strip() for subproblem in subproblems]
-
-        for idx, subproblem in enumerate(subproblems):
+    def _log_plan(self, subproblems):
+        for subproblem in subproblems:
             LOGGER.log_with_depth(f"<subproblem>{subproblem}</subproblem>", depth=1)
 
         LOGGER.log_with_depth(f"[Action] Solve each subproblem...", depth=1)
-        problem_results = []
-        for sub_problem in subproblems:
-            LOGGER.log_with_depth(f"Solving...", depth=1)
-            response = safety_agent_ins.request(
-                f"The original user problem is: {self.user_prompt}\nNow, solve this problem: {sub_problem}"
-            )
-
-            if response == "":
-                LOGGER.log_with_depth(
-                    f"<solution>No solution found</solution>", depth=1
-                )
-                problem_results.append("No solution found")
-            else:
-                LOGGER.log_with_depth(f"<solution>{response}</solution>", depth=1)
-                problem_results.append(response)
-
-        return "\n".join(problem_results)
-
-    def enrollment_agent(self, eligibility_criteria, drug_name, disease_name):
-        LOGGER.log_with_depth(f"", depth=1)
-        LOGGER.log_with_depth(f"Enrollment Agent...", depth=1)
-        LOGGER.log_with_depth(f"Planing...", depth=1)
-        LOGGER.log_with_depth(
-            f"[Thought] Least to Most Reasoning: Decompose the original problem",
-            depth=1,
-        )
 
-        enrollment_agent_ins = EnrollmentAgent(depth=2)
-
-        response = enrollment_agent_ins.request(
-            f"The original user problem is: {self.user_prompt}\nNow, evaluate the enrollment difficulty of the clinical trial with eligibility criteria: {eligibility_criteria}, drugs: {drug_name}, diseases: {disease_name}"
-        )
+    def _subproblem_prompt(self, sub_problem):
+        return f"The original user problem is: {self.user_prompt}\nNow, solve this problem: {sub_problem}"
 
+    def _solution(self, response):
         if response == "":
             LOGGER.log_with_depth(f"<solution>No solution found</solution>", depth=1)
             return "No solution found"
-        else:
-            LOGGER.log_with_depth(f"<solution>{response}</solution", depth=1)
-            return response
 
-    def efficiency_agent(self, drug_name, disease_name):
-        LOGGER.log_with_depth(f"", depth=1)
-        LOGGER.log_with_depth(f"Efficiency Agent...", depth=1)
-        LOGGER.log_with_depth(f"Planing...", depth=1)
-        LOGGER.log_with_depth(
-            f"[Thought] Least to Most Reasoning: Decompose the original problem",
-            depth=1,
-        )
+        LOGGER.log_with_depth(f"<solution>{response}</solution>", depth=1)
+        return response
+
+    def _enrollment_prompt(self, eligibility_criteria, drug_name, disease_name):
+        return f"The original user problem is: {self.user_prompt}\nNow, evaluate the enrollment difficulty of the clinical trial with eligibility criteria: {eligibility_criteria}, drugs: {drug_name}, diseases: {disease_name}"
 
-        efficiency_agent_ins = EfficiencyAgent(depth=2)
+    def _graph_reasoning_prompt(self, keyword_1, keyword_2, user_instruction):
+        return f"""The user problem is: {self.user_prompt}\n. This is the user request: "{user_instruction}". How can I get the relevant context from graph knowledgebase about relationship between {keyword_1} and {keyword_2}?"""
 
-        decomposed_resp = decomposition(
-            f"How can I evaluate the efficiency of the drug {drug_name} on the disease {disease_name}?",
-            tools=efficiency_agent_ins.tools,
+    def _solve_plan(self, agent_ins, question, drug_name, disease_name):
+        subproblems = plan_subproblems(
+            question,
+            tools=agent_ins.tools,
+            drug_name=drug_name,
+            disease_name=disease_name,
         )
+        self._log_plan(subproblems)
 
-        subproblems = re.findall(r"<subproblem>(.*?)</subproblem>", decomposed_resp)
-        subproblems = [subproblem.strip() for subproblem in subproblems]
+        problem_results = []
+        for sub_problem in subproblems:
+            LOGGER.log_with_depth(f"Solving...", depth=1)
+            response = agent_ins.request(self._subproblem_prompt(sub_problem))
+            problem_results.append(self._solution(response))
 
-        for idx, subproblem in enumerate(subproblems):
-            LOGGER.log_with_depth(f"<subproblem>{subproblem}</subproblem>", depth=1)
+        return "\n".join(problem_results)
 
-        LOGGER.log_with_depth(f"[Action] Solve each subproblem...", depth=1)
+    async def _asolve_plan(self, agent_ins, question, drug_name, disease_name):
+        subproblems = await aplan_subproblems(
+            question,
+            tools=agent_ins.tools,
+            drug_name=drug_name,
+            disease_name=disease_name,
+        )
+        self._log_plan(subproblems)
 
+        # The subproblems share the agent's conversation, they are solved in order
         problem_results = []
         for sub_problem in subproblems:
-            response = efficiency_agent_ins.request(
-                f"The original user problem is: {self.user_prompt}\nNow, solve this problem: {sub_problem}"
-            )
-
-            if response == "":
-                LOGGER.log_with_depth(
-                    f"<solution>No solution found</solution>", depth=1
-                )
-                problem_results.append("No solution found")
-            else:
-                LOGGER.log_with_depth(f"<solution>{response}</solution>", depth=1)
-                problem_results.append(response)
+            LOGGER.log_with_depth(f"Solving...", depth=1)
+            response = await agent_ins.arequest(self._subproblem_prompt(sub_problem))
+            problem_results.append(self._solution(response))
 
         return "\n".join(problem_results)
 
-    def graph_reasoning_agent(self, keyword_1, keyword_2, user_instruction):
-        LOGGER.log_with_depth(f"", depth=1)
-        LOGGER.log_with_depth(f"GraphReasoningAgent Agent...", depth=1)
-        LOGGER.log_with_depth(f"Planing...", depth=1)
-        LOGGER.log_with_depth(
-            f"[Thought] Least to Most Reasoning: Decompose the original problem",
-            depth=1,
+    # Every specialist tool has an async variant, which LLMAgent.arequest awaits on the event loop
+
+    def safety_agent(self, drug_name, disease_name):
+        self._log_specialist("Safety Agent")
+        return self._solve_plan(
+            SafetyAgent(depth=2), SAFETY_QUESTION, drug_name, disease_name
         )
 
-        graph_reasoning_agent_ins = GraphReasoningAgent(depth=2)
+    async def asafety_agent(self, drug_name, disease_name):
+        self._log_specialist("Safety Agent")
+        return await self._asolve_plan(
+            SafetyAgent(depth=2), SAFETY_QUESTION, drug_name, disease_name
+        )
 
-        response = graph_reasoning_agent_ins.request(
-            f"""The user problem is: {self.user_prompt}\n. This is the user request: "{user_instruction}". How can I get the relevant context from graph knowledgebase about relationship between {keyword_1} and {keyword_2}?"""
+    def enrollment_agent(self, eligibility_criteria, drug_name, disease_name):
+        self._log_specialist("Enrollment Agent")
+        response = EnrollmentAgent(depth=2).request(
+            self._enrollment_prompt(eligibility_criteria, drug_name, disease_name)
         )
+        return self._solution(response)
 
-        if response == "":
-            LOGGER.log_with_depth(f"<solution>No solution found</solution>", depth=1)
-            return "No solution found"
+    async def aenrollment_agent(self, eligibility_criteria, drug_name, disease_name):
+        self._log_specialist("Enrollment Agent")
+        response = await EnrollmentAgent(depth=2).arequest(
+            self._enrollment_prompt(eligibility_criteria, drug_name, disease_name)
+        )
+        return self._solution(response)
 
-        LOGGER.log_with_depth(f"<solution>{response}</solution>", depth=1)
-        return response
+    def efficiency_agent(self, drug_name, disease_name):
+        self._log_specialist("Efficiency Agent")
+        return self._solve_plan(
+            EfficiencyAgent(depth=2), EFFICIENCY_QUESTION, drug_name, disease_name
+        )
+
+    async def aefficiency_agent(self, drug_name, disease_name):
+        self._log_specialist("Efficiency Agent")
+        return await self._asolve_plan(
+            EfficiencyAgent(depth=2), EFFICIENCY_QUESTION, drug_name, disease_name
+        )
+
+    def graph_reasoning_agent(self, keyword_1, keyword_2, user_instruction):
+        self._log_specialist("GraphReasoningAgent Agent")
+        response = GraphReasoningAgent(depth=2).request(
+            self._graph_reasoning_prompt(keyword_1, keyword_2, user_instruction)
+        )
+        return self._solution(response)
+
+    async def agraph_reasoning_agent(self, keyword_1, keyword_2, user_instruction):
+        self._log_specialist("GraphReasoningAgent Agent")
+        response = await GraphReasoningAgent(depth=2).arequest(
+            self._graph_reasoning_prompt(keyword_1, keyword_2, user_instruction)
+        )
+        return self._solution(response)
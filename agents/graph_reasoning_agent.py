@@ -4,16 +4,22 @@ import networkx as nx
 from openai import OpenAI
 
 from core.constants import LLMConstants
+from core.resources import lazy_resource
+from core.utils import LLM_LIMITER
 
 from .LLMAgent import LLMAgent
 from .tools.graph_reasoning.GraphReasoning import (
     AutoModel,
     AutoTokenizer,
+    EmbeddingStore,
+    IVFIndex,
+    NodeEmbeddingIndex,
     find_path_and_reason,
     generate_node_embeddings,
     load_embeddings,
     make_graph_from_text,
     save_embeddings,
+    update_node_embeddings,
 )
 
 DATA_DIR = "./graph_reasoning/notebooks/GRAPHDATA"
@@ -24,28 +30,124 @@ GRAPH_ROOT = "knowledgebasecondensed"
 
 TOKENIZER_MODEL = "BAAI/bge-large-en-v1.5"
 
-embedding_tokenizer = AutoTokenizer.from_pretrained(
-    TOKENIZER_MODEL,
-)
-embedding_model = AutoModel.from_pretrained(
-    TOKENIZER_MODEL,
-)
+GRAPH_PATH = f"{DATA_DIR}/{GRAPH_ROOT}_graphML.graphml"
+EMBEDDING_PATH = f"{DATA_DIR}/{GRAPH_ROOT}_embeddings_ge-large-en-v1.5"
+IVF_INDEX_PATH = f"{EMBEDDING_PATH}/ivf_index"
+
+# Graphs with more nodes are searched with an approximate IVFIndex instead of exact search
+ANN_MIN_NODES = 200_000
+
+
+@lazy_resource("bge_large")
+def bge_large_model():
+    embedding_tokenizer = AutoTokenizer.from_pretrained(
+        TOKENIZER_MODEL,
+    )
+    embedding_model = AutoModel.from_pretrained(
+        TOKENIZER_MODEL,
+    )
+    return embedding_tokenizer, embedding_model
+
+
 client = OpenAI(api_key=LLMConstants.OPENAI_API_KEY)
 
 
 def complete_message_with_4o(system_prompt, prompt, temperature=0.333, max_tokens=4096):
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": [{"type": "text", "text": prompt}]},
-        ],
-        temperature=temperature,
-        max_tokens=max_tokens,
-    )
+    # Counted against the same in-flight request limit as llm_request and allm_request
+    with LLM_LIMITER:
+        response = client.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": [{"type": "text", "text": prompt}]},
+            ],
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
     return response.choices[0].message.content
 
 
+def node_search_index(node_embeddings):
+    """
+    Build the index searched for keyword nodes once, so a question only pays for the search.
+
+    The IVFIndex of a large graph is saved with the embedding store and reused while the store
+    keeps the same checksum.
+    """
+    if len(node_embeddings) < ANN_MIN_NODES:
+        return NodeEmbeddingIndex(node_embeddings.node_ids, node_embeddings.matrix)
+
+    if IVFIndex.exists(IVF_INDEX_PATH):
+        index = IVFIndex.load(IVF_INDEX_PATH)
+        if index.metadata.get("store_checksum") == node_embeddings.checksum:
+            return index
+
+    index = IVFIndex.build(node_embeddings.node_ids, node_embeddings.matrix)
+    index.metadata["store_checksum"] = node_embeddings.checksum
+    index.save(IVF_INDEX_PATH)
+
+    return index
+
+
+@lazy_resource(
+    "graph_reasoning_graph",
+    watch=lambda: [GRAPH_PATH, f"{EMBEDDING_PATH}/meta.json"],
+)
+def graph_reasoning_graph():
+    """
+    The knowledge graph, its node embeddings and their search index, shared read-only by every
+    GraphReasoningAgent.
+
+    Loaded once per process, and again when the GraphML file or the embedding store changes.
+    """
+    embedding_tokenizer, embedding_model = bge_large_model()
+
+    if os.path.exists(GRAPH_PATH):
+        G = nx.read_graphml(GRAPH_PATH)
+
+    else:
+        with open(os.path.join(TEXT_INPUT_DIR, GRAPH_TEXT_FILE_NAME), "r") as f:
+            text = f.read()
+            graph_HTML, graph_GraphML, G, net, _ = make_graph_from_text(
+                txt=text,
+                graph_root=GRAPH_ROOT,
+                generate=complete_message_with_4o,
+                data_dir=DATA_DIR,
+                chunk_size=2500,
+            )
+
+    legacy_embedding_path = f"{EMBEDDING_PATH}.pkl"
+
+    if EmbeddingStore.exists(EMBEDDING_PATH):
+        node_embeddings = load_embeddings(EMBEDDING_PATH, TOKENIZER_MODEL)
+
+    else:
+        if os.path.exists(legacy_embedding_path):
+            # Converted once from the pickled dict of earlier versions
+            node_embeddings = load_embeddings(legacy_embedding_path)
+        else:
+            node_embeddings = generate_node_embeddings(
+                G,
+                embedding_tokenizer,
+                embedding_model,
+            )
+        node_embeddings = save_embeddings(
+            node_embeddings, EMBEDDING_PATH, TOKENIZER_MODEL
+        )
+
+    # A graph edited since its embeddings were saved gets embeddings for its new nodes
+    if any(node not in node_embeddings for node in G.nodes):
+        node_embeddings = save_embeddings(
+            update_node_embeddings(
+                node_embeddings, G, embedding_tokenizer, embedding_model
+            ),
+            EMBEDDING_PATH,
+            TOKENIZER_MODEL,
+        )
+
+    return G, node_embeddings, node_search_index(node_embeddings)
+
+
 class GraphReasoningAgent(LLMAgent):
     def __init__(self, depth=1):
         self.name = "graph_reasoning_agent"
@@ -87,36 +189,8 @@ class GraphReasoningAgent(LLMAgent):
         super().__init__(self.name, self.role, tools=self.tools, depth=depth)
 
     def answer_to_instruction(self, keyword_1, keyword_2, user_instruction):
-
-        graph_name = f"{DATA_DIR}/{GRAPH_ROOT}_graphML.graphml"
-
-        if os.path.exists(graph_name):
-            G = nx.read_graphml(graph_name)
-
-        else:
-            with open(os.path.join(TEXT_INPUT_DIR, GRAPH_TEXT_FILE_NAME), "r") as f:
-                text = f.read()
-                graph_HTML, graph_GraphML, G, net, _ = make_graph_from_text(
-                    txt=text,
-                    graph_root=GRAPH_ROOT,
-                    generate=complete_message_with_4o,
-                    data_dir=DATA_DIR,
-                    chunk_size=2500,
-                )
-
-        embedding_file = f"{GRAPH_ROOT}_embeddings_ge-large-en-v1.5.pkl"
-        embedding_path = f"{DATA_DIR}/{embedding_file}"
-
-        if os.path.exists(embedding_path):
-            node_embeddings = load_embeddings(embedding_path)
-
-        else:
-            node_embeddings = generate_node_embeddings(
-                G,
-                embedding_tokenizer,
-                embedding_model,
-            )
-            save_embeddings(node_embeddings, embedding_path)
+        embedding_tokenizer, embedding_model = bge_large_model()
+        G, _, node_index = graph_reasoning_graph()
 
         (
             response,
@@ -128,7 +202,7 @@ class GraphReasoningAgent(LLMAgent):
             graph_GraphML,
         ) = find_path_and_reason(
             G,
-            node_embeddings,
+            node_index,
             embedding_tokenizer,
             embedding_model,
             complete_message_with_4o,
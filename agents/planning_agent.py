@@ -1,4 +1,8 @@
 import json
+import re
+import threading
+
+from core.constants import ExecutionConstants
 
 from .LLMAgent import LLMAgent
 
@@ -22,7 +26,7 @@ Answer:
 """
 
 
-def decomposition(original_problem, tools=None):
+def decomposition_agent(tools=None):
     name = "decomposition_agent"
 
     role = f"""
@@ -46,8 +50,176 @@ def decomposition(original_problem, tools=None):
 
         role += f"\n The following tools are available for you to use: <tools>{func_content}</tools>."
 
-    agent1 = LLMAgent(name, role, examples=examples)
+    return LLMAgent(name, role, examples=examples)
+
+
+def decomposition(original_problem, tools=None):
+    agent1 = decomposition_agent(tools)
 
     response = agent1.request(original_problem)
 
     return response
+
+
+async def adecomposition(original_problem, tools=None):
+    agent1 = decomposition_agent(tools)
+
+    response = await agent1.arequest(original_problem)
+
+    return response
+
+
+def parse_subproblems(decomposed_resp):
+    subproblems = re.findall(r"<subproblem>(.*?)</subproblem>", decomposed_resp)
+    return [subproblem.strip() for subproblem in subproblems]
+
+
+def decompose_subproblems(question_template, tools=None, **entities):
+    """
+    Decompose question_template instantiated for entities, without the plan cache.
+    """
+    return parse_subproblems(
+        decomposition(PlanCache._instantiate(question_template, entities), tools=tools)
+    )
+
+
+async def adecompose_subproblems(question_template, tools=None, **entities):
+    return parse_subproblems(
+        await adecomposition(
+            PlanCache._instantiate(question_template, entities), tools=tools
+        )
+    )
+
+
+class PlanCache:
+    """
+    Decomposed subproblem lists stored per question template and tool set.
+
+    A plan is decomposed for placeholder names such as [DRUG_NAME], never for real entities, kept
+    with {drug_name} style fields in their place, and instantiated for new entities without
+    another LLM call. When the LLM rewrites a placeholder beyond recognition, the plan is neither
+    kept nor used: the question is decomposed again for the real entities.
+    """
+
+    def __init__(self):
+        self.plans = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(question_template, tools):
+        tool_names = tuple(func["function"]["name"] for func in tools or [])
+        return question_template, tool_names
+
+    @staticmethod
+    def _placeholders(question_template):
+        return {
+            key: f"[{key.upper()}]" for key in re.findall(r"{(\w+)}", question_template)
+        }
+
+    @staticmethod
+    def _templatize(subproblem, placeholders):
+        for key, placeholder in placeholders.items():
+            # Tolerate a placeholder echoed as [drug name] or [DRUG-NAME]
+            pattern = r"[_\s-]".join(
+                re.escape(part) for part in placeholder[1:-1].split("_")
+            )
+            subproblem = re.sub(
+                rf"\[{pattern}\]",
+                lambda _: f"{{{key}}}",
+                subproblem,
+                flags=re.IGNORECASE,
+            )
+        return subproblem
+
+    @staticmethod
+    def _instantiate(template, entities):
+        for key, value in entities.items():
+            template = template.replace(f"{{{key}}}", value)
+        return template
+
+    def get_plan(self, question_template, tools=None, **entities):
+        """
+        Return the subproblems of question_template instantiated for entities, decomposing it on a miss.
+        """
+        plan = self._cached_plan(question_template, tools)
+
+        if plan is None:
+            plan = self.build_plan(question_template, tools)
+        if plan is None:
+            return decompose_subproblems(question_template, tools, **entities)
+
+        return [self._instantiate(template, entities) for template in plan]
+
+    async def aget_plan(self, question_template, tools=None, **entities):
+        plan = self._cached_plan(question_template, tools)
+
+        if plan is None:
+            plan = await self.abuild_plan(question_template, tools)
+        if plan is None:
+            return await adecompose_subproblems(question_template, tools, **entities)
+
+        return [self._instantiate(template, entities) for template in plan]
+
+    def _cached_plan(self, question_template, tools):
+        with self.lock:
+            return self.plans.get(self._key(question_template, tools))
+
+    def build_plan(self, question_template, tools=None):
+        """
+        Decompose question_template for placeholder entity names and store the plan as a template.
+
+        Returns None if the response has no subproblems or a placeholder that was not recognised.
+        """
+        placeholders = self._placeholders(question_template)
+
+        response = decomposition(
+            self._instantiate(question_template, placeholders), tools=tools
+        )
+
+        return self._store_plan(question_template, tools, response)
+
+    async def abuild_plan(self, question_template, tools=None):
+        placeholders = self._placeholders(question_template)
+
+        response = await adecomposition(
+            self._instantiate(question_template, placeholders), tools=tools
+        )
+
+        return self._store_plan(question_template, tools, response)
+
+    def _store_plan(self, question_template, tools, decomposed_resp):
+        placeholders = self._placeholders(question_template)
+        plan = [
+            self._templatize(subproblem, placeholders)
+            for subproblem in parse_subproblems(decomposed_resp)
+        ]
+
+        # An empty plan is most likely a malformed response, let the next call retry. A plan that
+        # rewrote a placeholder, as [DRUG NAME] or [the drug], would not name the new entities.
+        if len(plan) == 0 or any(
+            re.search(r"\[[^\[\]]*[A-Za-z][^\[\]]*\]", template) for template in plan
+        ):
+            return None
+
+        with self.lock:
+            return self.plans.setdefault(self._key(question_template, tools), plan)
+
+
+PLAN_CACHE = PlanCache()
+
+
+def plan_subproblems(question_template, tools=None, **entities):
+    """
+    Return the subproblems of question_template instantiated for entities.
+    """
+    if ExecutionConstants.PLAN_CACHE_ENABLED:
+        return PLAN_CACHE.get_plan(question_template, tools, **entities)
+
+    return decompose_subproblems(question_template, tools, **entities)
+
+
+async def aplan_subproblems(question_template, tools=None, **entities):
+    if ExecutionConstants.PLAN_CACHE_ENABLED:
+        return await PLAN_CACHE.aget_plan(question_template, tools, **entities)
+
+    return await adecompose_subproblems(question_template, tools, **entities)
@@ -1,5 +1,5 @@
 from .LLMAgent import LLMAgent
-from .tools.risk_model import get_disease_risk, get_drug_risk
+from .tools.risk_model import get_disease_risk_stats, get_drug_risk_stats
 
 
 class SafetyAgent(LLMAgent):
@@ -47,12 +47,18 @@ class SafetyAgent(LLMAgent):
 
         super().__init__(self.name, self.role, tools=self.tools, depth=depth)
 
-    def get_disease_risk(self, disease_name):
-        result = get_disease_risk(disease_name)
+    @staticmethod
+    def format_risk(name, stats):
+        if stats is None:
+            return f"The historical failure rate of {name} in clinical trials is None."
 
-        return f"The historical failure rate of {disease_name} in clinical trials is {result}."
+        return (
+            f"The historical failure rate of {name} in clinical trials is {stats['risk']} "
+            f"(95% confidence interval {stats['low']}-{stats['high']}, over {stats['trials']} trials)."
+        )
 
-    def get_drug_risk(self, drug_name):
-        result = get_drug_risk(drug_name)
+    def get_disease_risk(self, disease_name):
+        return self.format_risk(disease_name, get_disease_risk_stats(disease_name))
 
-        return f"The historical failure rate of {drug_name} in clinical trials is {result}."
+    def get_drug_risk(self, drug_name):
+        return self.format_risk(drug_name, get_drug_risk_stats(drug_name))
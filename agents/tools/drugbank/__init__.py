@@ -3,59 +3,79 @@ import sys
 
 import pandas as pd
 
-from core.utils import match_name
+from core.resources import lazy_resource
+from core.utils import NameMatcher, match_name
 
 cwd_path = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(f"{cwd_path}/../../")
 
-drugbank_df = pd.read_csv(f"{cwd_path}/data/drugbank.csv", sep="\t")
-drug_names = drugbank_df["name"].str.lower().tolist()
+DRUGBANK_COLUMNS = [
+    "name",
+    "description",
+    "indication",
+    "smiles",
+    "absorption",
+    "distribution",
+    "metabolism",
+    "excretion",
+    "toxicity",
+]
 
 
-def retrieval_drugbank(drug_name):
+def build_drugbank_index(drugbank_path):
+    """
+    Build a dict of lowercase drug name to its DrugBank record, keeping the first row of duplicated names.
+    """
+    drugbank_df = pd.read_csv(drugbank_path, sep="\t", usecols=DRUGBANK_COLUMNS)
+    drugbank_df = drugbank_df.dropna(subset=["name"])
+    drugbank_df.index = drugbank_df["name"].str.lower()
+    drugbank_df = drugbank_df[~drugbank_df.index.duplicated(keep="first")]
+
+    return drugbank_df.to_dict("index")
+
+
+@lazy_resource("drugbank")
+def drugbank():
+    drugbank_index = build_drugbank_index(f"{cwd_path}/data/drugbank.csv")
+    return drugbank_index, NameMatcher(drugbank_index)
+
+
+def lookup_drug(drug_name):
+    drugbank_index, drugbank_matcher = drugbank()
+
     drug_name = drug_name.strip().lower()
-    drug_name = match_name(drug_name, drug_names)
+    drug_name = match_name(drug_name, drugbank_matcher)
 
-    db_row = drugbank_df[drugbank_df["name"] == drug_name]
+    return drugbank_index.get(drug_name)
 
-    if db_row.empty:
-        return ""
 
-    drug_name = db_row["name"].values[0]
-    drug_description = db_row["description"].values[0]
-    drug_indication = db_row["indication"].values[0]
-    drug_smiles = db_row["smiles"].values[0]
-    drug_absorption = db_row["absorption"].values[0]
-    drug_distribution = db_row["distribution"].values[0]
-    drug_metabolism = db_row["metabolism"].values[0]
-    drug_excretion = db_row["excretion"].values[0]
-    drug_toxicity = db_row["toxicity"].values[0]
+def retrieval_drugbank(drug_name):
+    db_row = lookup_drug(drug_name)
+
+    if db_row is None:
+        return ""
 
     drugbank_info = f""" 
-    <drug name>{drug_name}</drug name>,
-    <drug description>{drug_description}</drug description>,
-    <drug pharmacology indication>{drug_indication}</drug pharmacology indication>,
-    <drug absorption>{drug_absorption}</drug absorption>,
-    <drug volume-of-distribution>{drug_distribution}</drug volume-of-distribution>,
-    <drug metabolism>{drug_metabolism}</drug metabolism>,
-    <drug route-of-elimination>{drug_excretion}</drug route-of-elimination>,
-    <drug toxicity>{drug_toxicity}</drug toxicity>
+    <drug name>{db_row["name"]}</drug name>,
+    <drug description>{db_row["description"]}</drug description>,
+    <drug pharmacology indication>{db_row["indication"]}</drug pharmacology indication>,
+    <drug absorption>{db_row["absorption"]}</drug absorption>,
+    <drug volume-of-distribution>{db_row["distribution"]}</drug volume-of-distribution>,
+    <drug metabolism>{db_row["metabolism"]}</drug metabolism>,
+    <drug route-of-elimination>{db_row["excretion"]}</drug route-of-elimination>,
+    <drug toxicity>{db_row["toxicity"]}</drug toxicity>
     """
 
     return drugbank_info
 
 
 def get_SMILES(drug_name):
-    drug_name = drug_name.strip().lower()
-
-    drug_name = match_name(drug_name, drug_names)
-
-    db_row = drugbank_df[drugbank_df["name"] == drug_name]
+    db_row = lookup_drug(drug_name)
 
-    if db_row.empty:
+    if db_row is None:
         return ""
 
-    return db_row["smiles"].values[0]
+    return db_row["smiles"]
 
 
 if __name__ == "__main__":
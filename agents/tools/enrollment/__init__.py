@@ -1,5 +1,5 @@
 import os
-from xml.etree import ElementTree as ET
+import sys
 
 import numpy as np
 import pandas as pd
@@ -8,13 +8,33 @@ import torch.nn as nn
 from sklearn.metrics import roc_auc_score
 from sklearn.model_selection import train_test_split
 from sklearn.utils.class_weight import compute_class_weight
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import AutoModel, AutoTokenizer
 
 current_file_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{current_file_path}/../../../")
+
+from agents.tools.enrollment.cpu_inference import (
+    parity_report,
+    pin_threads,
+    quantize_criteria_model,
+    quantize_linear_layers,
+    trace_criteria_model,
+)
+from agents.tools.enrollment.embedding_cache import SentenceEmbeddingCache
+from agents.tools.enrollment.trial_embeddings import (
+    TrialEmbeddingDataset,
+    TrialEmbeddingStore,
+)
+from agents.tools.trial_data import ingest_trials, load_trials
+from core.constants import InferenceConstants
+from core.resources import lazy_resource
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+BIOBERT_MODEL_NAME = "dmis-lab/biobert-base-cased-v1.2"
+
 
 class CriteriaModel(nn.Module):
     def __init__(self):
@@ -82,19 +102,101 @@ def partition_criteria(criteria):
     return inclusion_criteria, exclusion_criteria
 
 
-def wrapper_get_sentence_embedding():
-    model_name = "dmis-lab/biobert-base-cased-v1.2"
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    model = AutoModel.from_pretrained(model_name).to(device)
+@lazy_resource("biobert")
+def biobert():
+    tokenizer = AutoTokenizer.from_pretrained(BIOBERT_MODEL_NAME)
+    model = AutoModel.from_pretrained(BIOBERT_MODEL_NAME).to(device)
+    model.eval()
+
+    return tokenizer, model
+
+
+@lazy_resource("biobert_int8")
+def biobert_int8():
+    tokenizer = AutoTokenizer.from_pretrained(BIOBERT_MODEL_NAME)
+    model = AutoModel.from_pretrained(BIOBERT_MODEL_NAME)
+    model.eval()
+
+    return tokenizer, quantize_linear_layers(model)
+
+
+@lazy_resource("sentence_embedding_cache")
+def sentence_embedding_cache():
+    return SentenceEmbeddingCache(f"{current_file_path}/data/embedding_cache")
+
+
+# Quantised embeddings differ slightly from the fp32 ones, they are cached separately
+@lazy_resource("sentence_embedding_cache_int8")
+def sentence_embedding_cache_int8():
+    return SentenceEmbeddingCache(f"{current_file_path}/data/embedding_cache_int8")
+
+
+# backend: (BioBERT resource, embedding cache resource, device)
+BIOBERT_BACKENDS = {
+    "fp32": (biobert, sentence_embedding_cache, device),
+    "int8": (biobert_int8, sentence_embedding_cache_int8, torch.device("cpu")),
+}
+
+
+def get_sentence_embeddings(sentences, batch_size=32, use_cache=True, backend="fp32"):
+    """
+    Return the BioBERT [CLS] embeddings of sentences as a (len(sentences), 768) tensor.
+
+    Cached sentences are read from the embedding cache, the others are embedded and added to it.
+    """
+    if not use_cache:
+        return compute_sentence_embeddings(sentences, batch_size, backend)
+
+    cache = BIOBERT_BACKENDS[backend][1]()
+    embeddings = cache.get_many(sentences)
+
+    missing = list(
+        dict.fromkeys(
+            sentence
+            for sentence, embedding in zip(sentences, embeddings)
+            if embedding is None
+        )
+    )
+    if len(missing) > 0:
+        computed = compute_sentence_embeddings(missing, batch_size, backend)
+        cache.put_many(missing, computed)
+
+        computed = dict(zip(missing, computed))
+        embeddings = [
+            computed[sentence] if embedding is None else embedding
+            for sentence, embedding in zip(sentences, embeddings)
+        ]
+
+    if len(embeddings) == 0:
+        return torch.empty(0, 768)
 
-    def get_sentence_embedding(sentence):
-        # Encode the input string
+    return torch.stack(embeddings)
+
+
+def compute_sentence_embeddings(sentences, batch_size=32, backend="fp32"):
+    """
+    Run BioBERT on sentences, sorted by length and padded per batch so each batch wastes little padding.
+    """
+    biobert_resource, _, model_device = BIOBERT_BACKENDS[backend]
+    tokenizer, model = biobert_resource()
+
+    order = sorted(range(len(sentences)), key=lambda idx: len(sentences[idx]))
+    embeddings = [None] * len(sentences)
+
+    for start in range(0, len(order), batch_size):
+        batch_ids = order[start : start + batch_size]
+
+        # Encode the input strings
         inputs = tokenizer(
-            sentence, return_tensors="pt", truncation=True, padding=True, max_length=512
+            [sentences[idx] for idx in batch_ids],
+            return_tensors="pt",
+            truncation=True,
+            padding=True,
+            max_length=512,
         )
 
         # Send inputs to the same device as model
-        inputs = {k: v.to(device) for k, v in inputs.items()}
+        inputs = {k: v.to(model_device) for k, v in inputs.items()}
 
         # Get the output from BioBERT
         with torch.no_grad():  # Disable gradient calculation for inference
@@ -102,50 +204,174 @@ def wrapper_get_sentence_embedding():
 
         # Obtain the embeddings for the [CLS] token
         # The [CLS] token is used in BERT-like models to represent the entire sentence
-        cls_embedding = outputs.last_hidden_state[:, 0, :].squeeze().to("cpu")
+        cls_embeddings = outputs.last_hidden_state[:, 0, :].to("cpu")
 
-        return cls_embedding
+        for idx, cls_embedding in zip(batch_ids, cls_embeddings):
+            embeddings[idx] = cls_embedding
 
-    return get_sentence_embedding
+    if len(embeddings) == 0:
+        return torch.empty(0, 768)
 
+    return torch.stack(embeddings)
 
-# Get the sentence embedding function
-get_sentence_embedding = wrapper_get_sentence_embedding()
 
+def get_sentence_embedding(sentence):
+    return get_sentence_embeddings([sentence])[0]
 
-def get_enrollment_difficulty(criteria, drugs, diseases):
+
+def trial_sentences(criteria, drugs, diseases):
+    """
+    Split a trial into its inclusion text, exclusion text, drug names and disease names.
+    """
     drugs = drugs.strip().lower()
     diseases = diseases.strip().lower()
 
     inclusion_criteria, exclusion_criteria = partition_criteria(criteria)
-    inclusion_criteria_emb = get_sentence_embedding("\n".join(inclusion_criteria))
-    exclusion_criteria_emb = get_sentence_embedding("\n".join(exclusion_criteria))
-    drugs_emb = torch.mean(
-        torch.stack([get_sentence_embedding(drug) for drug in drugs.split(";")]), dim=0
+
+    return (
+        "\n".join(inclusion_criteria),
+        "\n".join(exclusion_criteria),
+        drugs.split(";"),
+        diseases.split(";"),
+    )
+
+
+def get_trial_embeddings(trials, batch_size=32, backend="fp32"):
+    """
+    Return the (len(trials), 4 * 768) model input of (criteria, drugs, diseases) trials.
+    """
+    trials = [trial_sentences(*trial) for trial in trials]
+
+    # Every distinct string is embedded once for the whole batch
+    sentences = []
+    for inclusion, exclusion, drugs, diseases in trials:
+        sentences.extend([inclusion, exclusion, *drugs, *diseases])
+    sentences = list(dict.fromkeys(sentences))
+
+    embeddings = dict(
+        zip(sentences, get_sentence_embeddings(sentences, batch_size, backend=backend))
     )
-    diseases_emb = torch.mean(
-        torch.stack(
-            [get_sentence_embedding(disease) for disease in diseases.split(";")]
-        ),
-        dim=0,
+
+    return torch.stack(
+        [
+            torch.cat(
+                (
+                    embeddings[inclusion],
+                    embeddings[exclusion],
+                    torch.mean(torch.stack([embeddings[d] for d in drugs]), dim=0),
+                    torch.mean(torch.stack([embeddings[d] for d in diseases]), dim=0),
+                ),
+                dim=0,
+            )
+            for inclusion, exclusion, drugs, diseases in trials
+        ]
     )
 
-    if os.path.exists(f"{current_file_path}/data/enrollment_model.pt"):
-        model = CriteriaModel().to(device)
-        model.load_state_dict(
-            torch.load(f"{current_file_path}/data/enrollment_model.pt")
+
+def build_trial_embeddings(trial_df, store, chunk_size=512, batch_size=32):
+    """
+    Embed the trials of trial_df missing from store, writing one shard per chunk of trials.
+    """
+    pending_df = trial_df[~trial_df["nctid"].isin(store.locations)]
+    print(f"{len(trial_df) - len(pending_df)} trials already embedded")
+
+    for start in tqdm(range(0, len(pending_df), chunk_size)):
+        chunk_df = pending_df.iloc[start : start + chunk_size]
+        trials = list(
+            zip(chunk_df["criteria"], chunk_df["drugs"], chunk_df["diseases"])
         )
 
+        store.add(chunk_df["nctid"].tolist(), get_trial_embeddings(trials, batch_size))
+
+    return store
+
+
+def predict_logits(model, data_loader):
     model.eval()
     with torch.no_grad():
-        X = torch.cat(
-            (inclusion_criteria_emb, exclusion_criteria_emb, drugs_emb, diseases_emb),
-            dim=0,
-        ).unsqueeze(0)
-        y_pred = model(X.to(device))
-        y_pred = nn.Sigmoid()(y_pred).cpu().numpy().flatten()
+        return torch.cat(
+            [model(X_batch.to(device)).cpu() for X_batch, _ in data_loader]
+        ).flatten()
+
+
+class EnrollmentPredictor:
+    """
+    CriteriaModel loaded once, scoring trials with batched BioBERT embeddings.
+
+    The "int8" backend runs on CPU with dynamically quantised BioBERT and CriteriaModel MLP
+    layers, and a traced CriteriaModel. Check it against "fp32" with `check_backend_parity`.
+    """
+
+    def __init__(
+        self,
+        model_path=f"{current_file_path}/data/enrollment_model.pt",
+        batch_size=32,
+        backend=InferenceConstants.ENROLLMENT_BACKEND,
+        num_threads=InferenceConstants.NUM_THREADS,
+    ):
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"Enrollment model not found at {model_path}, train it by running `python __init__.py`."
+            )
+        if backend not in BIOBERT_BACKENDS:
+            raise ValueError(
+                f"Unknown enrollment backend {backend}, expected one of {list(BIOBERT_BACKENDS)}."
+            )
+
+        self.batch_size = batch_size
+        self.backend = backend
+        self.device = BIOBERT_BACKENDS[backend][2]
+
+        pin_threads(num_threads)
+
+        model = CriteriaModel().to(self.device)
+        model.load_state_dict(torch.load(model_path, map_location=self.device))
+        model.eval()
+
+        if backend == "int8":
+            model = trace_criteria_model(quantize_criteria_model(model))
+        self.model = model
+
+    def trial_embeddings(self, trials):
+        return get_trial_embeddings(trials, self.batch_size, self.backend)
+
+    def predict_proba(self, trials):
+        """
+        Return the enrollment difficulty of every (criteria, drugs, diseases) trial as an array.
+        """
+        if len(trials) == 0:
+            return np.empty(0, dtype=np.float32)
+
+        X = self.trial_embeddings(trials)
+
+        with torch.no_grad():
+            y_pred = self.model(X.to(self.device))
+            return nn.Sigmoid()(y_pred).cpu().numpy().flatten()
+
+    def predict_batch(self, trials):
+        return [round(float(y), 4) for y in self.predict_proba(trials)]
+
+    def predict(self, criteria, drugs, diseases):
+        return self.predict_batch([(criteria, drugs, diseases)])[0]
+
+
+def check_backend_parity(trials, labels=None, backend="int8", **kwargs):
+    """
+    Score trials with the fp32 and the given backend, report their probability and AUC deltas.
+    """
+    reference = EnrollmentPredictor(backend="fp32", **kwargs).predict_proba(trials)
+    candidate = EnrollmentPredictor(backend=backend, **kwargs).predict_proba(trials)
+
+    return parity_report(reference, candidate, labels)
+
+
+@lazy_resource("enrollment_model")
+def enrollment_predictor():
+    return EnrollmentPredictor()
+
 
-    return round(y_pred[0], 4)
+def get_enrollment_difficulty(criteria, drugs, diseases):
+    return enrollment_predictor().predict(criteria, drugs, diseases)
 
 
 if __name__ == "__main__":
@@ -166,158 +392,67 @@ if __name__ == "__main__":
             ]["studyid"]
         )
 
-        if os.path.exists(f"{current_file_path}/data/trial_data.csv"):
-            trial_df = pd.read_csv(f"{current_file_path}/data/trial_data.csv", sep="\t")
+        if os.path.exists(f"{current_file_path}/data/trial_data.parquet"):
+            trial_df = load_trials(f"{current_file_path}/data/trial_data.parquet")
+        elif os.path.exists(f"{current_file_path}/data/trial_data.csv"):
+            trial_df = load_trials(f"{current_file_path}/data/trial_data.csv")
         else:
             with open(f"{current_file_path}/data/trials/all_xml.txt", "r") as f:
-                trials_file_list = [line.strip() for line in f]
-
-            trial_data_list = []
-            for trial_path in tqdm(trials_file_list):
-                nctid = trial_path.split("/")[-1].split(".")[0]
-
-                if nctid not in iqvia_nctid_set:
-                    continue
-
-                try:
-                    root_xml = ET.parse(
-                        f"{current_file_path}/data/{trial_path}"
-                    ).getroot()
-                    criteria = (
-                        root_xml.find("eligibility")
-                        .find("criteria")
-                        .find("textblock")
-                        .text
-                    )
-                    if len(criteria) == 0:
-                        continue
-
-                    interventions = [i for i in root_xml.findall("intervention")]
-                    drug_interventions = [
-                        i.find("intervention_name").text.lower().strip()
-                        for i in interventions
-                        if i.find("intervention_type").text == "Drug"
-                    ]
-                    if len(drug_interventions) == 0:
-                        continue
-                    drugs = ";".join(drug_interventions)
-
-                    conditions = [
-                        i.text.lower().strip() for i in root_xml.findall("condition")
-                    ]
-                    if len(conditions) == 0:
-                        continue
-                    diseases = ";".join(conditions)
-
-                    if nctid in poor_set:
-                        label = 1
-                    else:
-                        label = 0
-
-                    trial_data_list.append((nctid, criteria, drugs, diseases, label))
-
-                except AttributeError:
-                    print(f"Don't have criteria or drug or diseases for {trial_path}")
-                except Exception as e:
-                    raise e
-
-            trial_df = pd.DataFrame(
-                trial_data_list,
-                columns=["nctid", "criteria", "drugs", "diseases", "label"],
-            )
-            trial_df.to_csv(
-                f"{current_file_path}/data/trial_data.csv", index=False, sep="\t"
+                trials_file_list = [
+                    f"{current_file_path}/data/{line.strip()}" for line in f
+                ]
+
+            ingest_trials(
+                trials_file_list,
+                f"{current_file_path}/data/trial_data.parquet",
+                nctid_set=iqvia_nctid_set,
+                positive_set=poor_set,
             )
-        if os.path.exists(f"{current_file_path}/data/trial_emb.pt"):
-            trial_emb = torch.load(f"{current_file_path}/data/trial_emb.pt")
-        else:
-            trial_emb_list = []
-            for row_idx, trial_row in tqdm(trial_df.iterrows(), total=len(trial_df)):
-                nctid = trial_row["nctid"]
-                criteria = trial_row["criteria"]
-                drugs = trial_row["drugs"].split(";")
-                diseases = trial_row["diseases"].split(";")
-
-                drugs_emb = torch.mean(
-                    torch.stack([get_sentence_embedding(drug) for drug in drugs]), dim=0
-                )
-                diseases_emb = torch.mean(
-                    torch.stack(
-                        [get_sentence_embedding(disease) for disease in diseases]
-                    ),
-                    dim=0,
-                )
+            trial_df = load_trials(f"{current_file_path}/data/trial_data.parquet")
 
-                inclusion_criteria, exclusion_criteria = partition_criteria(criteria)
+        trial_emb_store = TrialEmbeddingStore(f"{current_file_path}/data/trial_emb")
 
-                inclusion_criteria_emb = get_sentence_embedding(
-                    "\n".join(inclusion_criteria)
-                )
-                exclusion_criteria_emb = get_sentence_embedding(
-                    "\n".join(exclusion_criteria)
-                )
-
-                trial_emb_list.append(
-                    torch.cat(
-                        (
-                            inclusion_criteria_emb,
-                            exclusion_criteria_emb,
-                            drugs_emb,
-                            diseases_emb,
-                        ),
-                        dim=0,
-                    )
+        # Import the embeddings of a previous monolithic build, whose rows follow trial_df
+        if len(trial_emb_store) == 0 and os.path.exists(
+            f"{current_file_path}/data/trial_emb.pt"
+        ):
+            legacy_emb = torch.load(f"{current_file_path}/data/trial_emb.pt")
+            if len(legacy_emb) == len(trial_df):
+                trial_emb_store.add(trial_df["nctid"].tolist(), legacy_emb)
+            else:
+                # Built from another trial table, the trials are embedded again
+                print(
+                    f"Skipping trial_emb.pt: {len(legacy_emb)} embeddings for {len(trial_df)} trials"
                 )
 
-            trial_emb = torch.stack(trial_emb_list)
-            torch.save(trial_emb, f"{current_file_path}/data/trial_emb.pt")
-
-        print(trial_emb.shape)
-
-        X_data = trial_emb
-        y_data = []
-        for row_idx, trial_row in tqdm(trial_df.iterrows(), total=len(trial_df)):
-            nctid = trial_row["nctid"]
+        build_trial_embeddings(trial_df, trial_emb_store)
 
-            if nctid in poor_set:
-                y_data.append(1)
-            else:
-                y_data.append(0)
-
-        y_data = torch.tensor(y_data)
+        nctids = trial_df["nctid"].tolist()
+        y_data = [1 if nctid in poor_set else 0 for nctid in nctids]
 
-        print(f"len(X_data): {len(X_data)}")
+        print(f"len(X_data): {len(trial_emb_store)}")
         print(f"len(y_data): {len(y_data)}")
 
-        X_train, X_test, y_train, y_test = train_test_split(
-            X_data, y_data, test_size=0.2, random_state=0
+        nctids_train, nctids_test, y_train, y_test = train_test_split(
+            nctids, y_data, test_size=0.2, random_state=0
         )
+        y_train, y_test = np.array(y_train), np.array(y_test)
 
         class_weights = compute_class_weight(
             "balanced",
-            classes=np.unique(y_train.cpu().numpy()),
-            y=y_train.cpu().numpy(),
+            classes=np.unique(y_train),
+            y=y_train,
         )
         weight_for_positives = class_weights[1]
 
         pos_weight = torch.tensor([weight_for_positives]).to(device)
         print(pos_weight)
 
-        class CriteriaDataset(Dataset):
-            def __init__(self, X, y):
-                self.X = X
-                self.y = y
-
-            def __len__(self):
-                return len(self.X)
-
-            def __getitem__(self, idx):
-                return self.X[idx], self.y[idx]
-
-        train_dataset = CriteriaDataset(X_train, torch.tensor(y_train))
+        # Embeddings are read from the memory-mapped shards batch by batch
+        train_dataset = TrialEmbeddingDataset(trial_emb_store, nctids_train, y_train)
         train_loader = DataLoader(train_dataset, batch_size=64, shuffle=True)
 
-        test_dataset = CriteriaDataset(X_test, torch.tensor(y_test))
+        test_dataset = TrialEmbeddingDataset(trial_emb_store, nctids_test, y_test)
         test_loader = DataLoader(test_dataset, batch_size=64, shuffle=False)
 
         model = CriteriaModel().to(device)
@@ -337,36 +472,27 @@ if __name__ == "__main__":
                 loss.backward()
                 optimizer.step()
 
-            model.eval()
-            with torch.no_grad():
-                y_pred_test = model(X_test.to(device))
-                y_pred_test = y_pred_test.cpu().numpy().flatten()
-
-                auc_test = roc_auc_score(y_test, y_pred_test)
+            y_pred_test = predict_logits(model, test_loader).numpy()
+            auc_test = roc_auc_score(y_test, y_pred_test)
 
-                if auc_test > best_auc:
-                    best_auc = auc_test
-                    print(f"Epoch {epoch}\tBest AUC: {auc_test}, saving model...")
+            if auc_test > best_auc:
+                best_auc = auc_test
+                print(f"Epoch {epoch}\tBest AUC: {auc_test}, saving model...")
 
-                    torch.save(
-                        model.state_dict(),
-                        f"{current_file_path}/data/enrollment_model.pt",
-                    )
+                torch.save(
+                    model.state_dict(),
+                    f"{current_file_path}/data/enrollment_model.pt",
+                )
 
         # Final evaluation
         model.load_state_dict(
             torch.load(f"{current_file_path}/data/enrollment_model.pt")
         )
 
-        model.eval()
-        with torch.no_grad():
-            y_pred_test = model(X_test.to(device))
-            y_pred_test = nn.Sigmoid()(y_pred_test).cpu().numpy().flatten()
+        y_pred_test = nn.Sigmoid()(predict_logits(model, test_loader)).numpy()
 
-            auc_test = roc_auc_score(y_test, y_pred_test)
-            acc_test = ((y_pred_test > 0.5) == y_test.numpy()).mean()
-            recall_test = ((y_pred_test > 0.5) & (y_test.numpy() == 1)).sum() / (
-                y_test.numpy() == 1
-            ).sum()
+        auc_test = roc_auc_score(y_test, y_pred_test)
+        acc_test = ((y_pred_test > 0.5) == y_test).mean()
+        recall_test = ((y_pred_test > 0.5) & (y_test == 1)).sum() / (y_test == 1).sum()
 
-            print(f"AUC: {auc_test}, Accuracy: {acc_test}, Recall: {recall_test}")
+        print(f"AUC: {auc_test}, Accuracy: {acc_test}, Recall: {recall_test}")
@@ -0,0 +1,59 @@
+import numpy as np
+import torch
+import torch.nn as nn
+from sklearn.metrics import roc_auc_score
+
+
+def quantize_linear_layers(model, modules=None):
+    """
+    Return a copy of model with int8 dynamically quantised linear layers, for CPU inference.
+
+    `modules` restricts quantisation to the given submodule names, all nn.Linear layers by default.
+    """
+    return torch.ao.quantization.quantize_dynamic(
+        model, modules or {nn.Linear}, dtype=torch.qint8
+    )
+
+
+def quantize_criteria_model(model):
+    # The encoder layer stays fp32, its fused fast path reads the weights of linear1 and linear2
+    return quantize_linear_layers(model, {"fc1", "fc2"})
+
+
+def trace_criteria_model(model, batch_size=8):
+    """
+    Trace and freeze a CriteriaModel on a (batch_size, 4, 768) input, any batch size works afterwards.
+    """
+    example = torch.zeros(batch_size, 4, model.sentence_embedding_dim)
+
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(model.eval(), example))
+
+
+def pin_threads(num_threads):
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def parity_report(reference_probs, candidate_probs, labels=None):
+    """
+    Compare the probabilities of a candidate backend with the fp32 reference ones.
+    """
+    reference_probs = np.asarray(reference_probs, dtype=np.float64)
+    candidate_probs = np.asarray(candidate_probs, dtype=np.float64)
+    delta = np.abs(reference_probs - candidate_probs)
+
+    report = {
+        "max_prob_delta": float(delta.max(initial=0.0)),
+        "mean_prob_delta": float(delta.mean()) if len(delta) > 0 else 0.0,
+        "decision_flips": int(
+            ((reference_probs > 0.5) != (candidate_probs > 0.5)).sum()
+        ),
+    }
+
+    if labels is not None and len(np.unique(labels)) == 2:
+        report["auc_reference"] = float(roc_auc_score(labels, reference_probs))
+        report["auc_candidate"] = float(roc_auc_score(labels, candidate_probs))
+        report["auc_delta"] = report["auc_candidate"] - report["auc_reference"]
+
+    return report
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class SentenceEmbeddingCache:
+    """
+    Persistent cache of sentence embeddings keyed by the hash of the normalised sentence.
+
+    Embeddings are appended to a raw `dtype` matrix that is memory-mapped for reads, and the row of
+    every key is listed in an index file. Recently used embeddings are also kept in an in-memory LRU
+    tier of `memory_size` entries. A cache directory must only be written by one process at a time.
+    """
+
+    def __init__(self, directory, dim=768, dtype="float32", memory_size=100_000):
+        os.makedirs(directory, exist_ok=True)
+
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.memory_size = memory_size
+
+        self.index_path = os.path.join(directory, "index.txt")
+        self.matrix_path = os.path.join(directory, f"embeddings.{self.dtype.name}")
+
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        self._load()
+
+    @property
+    def row_bytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def _load(self):
+        keys = []
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                keys = [line.strip() for line in f if line.strip()]
+
+        matrix_rows = 0
+        if os.path.exists(self.matrix_path):
+            matrix_rows = os.path.getsize(self.matrix_path) // self.row_bytes
+
+        # Rows are written before their keys, an interrupted write leaves unindexed rows behind
+        n_rows = min(len(keys), matrix_rows)
+        if (
+            os.path.exists(self.matrix_path)
+            and os.path.getsize(self.matrix_path) != n_rows * self.row_bytes
+        ):
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(n_rows * self.row_bytes)
+        if len(keys) > n_rows:
+            with open(self.index_path, "w") as f:
+                f.writelines(f"{key}\n" for key in keys[:n_rows])
+
+        self.rows = {key: row for row, key in enumerate(keys[:n_rows])}
+        self._remap()
+
+    def _remap(self):
+        if len(self.rows) == 0:
+            self.matrix = None
+        else:
+            self.matrix = np.memmap(
+                self.matrix_path,
+                dtype=self.dtype,
+                mode="r",
+                shape=(len(self.rows), self.dim),
+            )
+
+    @staticmethod
+    def normalize(sentence):
+        # Whitespace does not change the BioBERT tokens, case does (cased model)
+        return " ".join(sentence.split())
+
+    @classmethod
+    def key(cls, sentence):
+        return hashlib.sha1(cls.normalize(sentence).encode("utf-8")).hexdigest()
+
+    def _remember(self, key, embedding):
+        self.memory[key] = embedding
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def get_many(self, sentences):
+        """
+        Return the cached float32 embedding of every sentence, None for the ones not cached yet.
+        """
+        embeddings = []
+
+        with self.lock:
+            for sentence in sentences:
+                key = self.key(sentence)
+
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    embedding = self.memory[key]
+                elif key in self.rows:
+                    embedding = torch.from_numpy(
+                        np.array(self.matrix[self.rows[key]], dtype=np.float32)
+                    )
+                    self._remember(key, embedding)
+                else:
+                    embedding = None
+
+                if embedding is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                embeddings.append(embedding)
+
+        return embeddings
+
+    def put_many(self, sentences, embeddings):
+        with self.lock:
+            new_keys, new_rows = {}, []
+            for sentence, embedding in zip(sentences, embeddings):
+                key = self.key(sentence)
+                embedding = embedding.detach().to("cpu", torch.float32)
+
+                self._remember(key, embedding)
+                if key not in self.rows and key not in new_keys:
+                    new_keys[key] = len(new_keys)
+                    new_rows.append(embedding.numpy().astype(self.dtype))
+
+            if len(new_keys) == 0:
+                return
+
+            with open(self.matrix_path, "ab") as f:
+                f.write(np.stack(new_rows).tobytes())
+            with open(self.index_path, "a") as f:
+                f.writelines(f"{key}\n" for key in new_keys)
+
+            for key in new_keys:
+                self.rows[key] = len(self.rows)
+            self._remap()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self)}
@@ -0,0 +1,92 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+
+class TrialEmbeddingStore:
+    """
+    Trial embeddings stored as .npy shards keyed by nctid and memory-mapped for reading.
+
+    Every shard is a `shard_XXXXX.npy` matrix plus a `shard_XXXXX.nctids.json` list of its row
+    nctids. The nctid list is written last, so a shard interrupted mid-write is ignored and rebuilt.
+    """
+
+    NCTIDS_SUFFIX = ".nctids.json"
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.shards = []
+        self.locations = {}
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(self.NCTIDS_SUFFIX):
+                self._open_shard(name[: -len(self.NCTIDS_SUFFIX)])
+
+    def _shard_path(self, shard_name, suffix):
+        return os.path.join(self.directory, f"{shard_name}{suffix}")
+
+    def _open_shard(self, shard_name):
+        with open(self._shard_path(shard_name, self.NCTIDS_SUFFIX), "r") as f:
+            nctids = json.load(f)
+        matrix = np.load(self._shard_path(shard_name, ".npy"), mmap_mode="r")
+
+        shard_id = len(self.shards)
+        self.shards.append(matrix)
+        for row, nctid in enumerate(nctids):
+            self.locations[nctid] = (shard_id, row)
+
+    def __contains__(self, nctid):
+        return nctid in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def add(self, nctids, embeddings):
+        """
+        Write the (len(nctids), dim) embeddings as a new shard.
+        """
+        shard_name = f"shard_{len(self.shards):05d}"
+        matrix_path = self._shard_path(shard_name, ".npy")
+        nctids_path = self._shard_path(shard_name, self.NCTIDS_SUFFIX)
+
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().cpu().numpy()
+
+        with open(f"{matrix_path}.tmp", "wb") as f:
+            np.save(f, np.asarray(embeddings, dtype=np.float32))
+        os.replace(f"{matrix_path}.tmp", matrix_path)
+
+        with open(f"{nctids_path}.tmp", "w") as f:
+            json.dump(list(nctids), f)
+        os.replace(f"{nctids_path}.tmp", nctids_path)
+
+        self._open_shard(shard_name)
+
+    def get(self, nctid):
+        shard_id, row = self.locations[nctid]
+        return torch.from_numpy(np.array(self.shards[shard_id][row]))
+
+    def get_many(self, nctids):
+        return torch.stack([self.get(nctid) for nctid in nctids])
+
+
+class TrialEmbeddingDataset(Dataset):
+    """
+    (embedding, label) pairs read lazily from a TrialEmbeddingStore.
+    """
+
+    def __init__(self, store, nctids, labels):
+        self.store = store
+        self.nctids = list(nctids)
+        self.labels = torch.as_tensor(labels)
+
+    def __len__(self):
+        return len(self.nctids)
+
+    def __getitem__(self, idx):
+        return self.store.get(self.nctids[idx]), self.labels[idx]
@@ -1,4 +1,7 @@
 from GraphReasoning.agents import *
+from GraphReasoning.ann_index import *
+from GraphReasoning.embedding_index import *
+from GraphReasoning.embedding_store import *
 from GraphReasoning.graph_analysis import *
 from GraphReasoning.graph_generation import *
 from GraphReasoning.graph_tools import *
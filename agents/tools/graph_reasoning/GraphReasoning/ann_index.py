@@ -0,0 +1,348 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from GraphReasoning.embedding_index import NodeEmbeddingIndex, top_k_positions
+
+
+def _assign(vectors, centroids, chunk_size=65536):
+    """
+    Return the most similar centroid of every normalised vector, in chunks of chunk_size vectors.
+    """
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[start : start + chunk_size], dtype=np.float32)
+        assignments[start : start + chunk_size] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+
+def spherical_kmeans(vectors, n_clusters, n_iter=10, seed=0):
+    """
+    Cluster normalised vectors by cosine similarity, returning the (n_clusters, dim) centroids.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignments = _assign(vectors, centroids)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        # Empty clusters restart from a random vector
+        empty = np.flatnonzero(np.bincount(assignments, minlength=n_clusters) == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+
+        centroids = NodeEmbeddingIndex.normalize(sums)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Approximate cosine-similarity search over node embeddings with an inverted file index.
+
+    The normalised embeddings are clustered by spherical k-means into n_lists lists and stored
+    grouped by list: list i holds vectors[list_offsets[i]:list_offsets[i + 1]]. A query only
+    scores the vectors of its n_probe most similar lists. Nodes added after the build are kept in
+    a small in-memory buffer, searched along with the lists, until the index is saved.
+    """
+
+    FORMAT_VERSION = 1
+    ARRAYS = ["centroids", "list_offsets", "vectors"]
+
+    def __init__(
+        self, node_ids, centroids, list_offsets, vectors, n_probe=8, metadata=None
+    ):
+        self.node_ids = list(node_ids)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.vectors = vectors
+        self.n_probe = n_probe
+        self.metadata = dict(metadata or {})
+
+        dim = centroids.shape[1]
+        self.added_ids = []
+        self.added_vectors = np.empty((0, dim), dtype=np.float32)
+        self.added_lists = np.empty(0, dtype=np.int64)
+
+    @classmethod
+    def build(
+        cls,
+        node_ids,
+        matrix,
+        n_lists=None,
+        n_probe=8,
+        n_iter=10,
+        max_training_size=100_000,
+        dtype=np.float32,
+        seed=0,
+    ):
+        """
+        Build the index of the (n_nodes, dim) embedding matrix of node_ids.
+
+        n_lists defaults to 4 * sqrt(n_nodes). Centroids are trained on at most max_training_size
+        vectors, and the vectors are stored as dtype, np.float16 halving the memory footprint.
+        """
+        node_ids = list(node_ids)
+        vectors = NodeEmbeddingIndex.normalize(
+            np.asarray(matrix, dtype=np.float32).reshape(len(node_ids), -1)
+        )
+
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        rng = np.random.default_rng(seed)
+        training = vectors
+        if len(vectors) > max_training_size:
+            training = vectors[
+                np.sort(rng.choice(len(vectors), max_training_size, replace=False))
+            ]
+        centroids = spherical_kmeans(training, n_lists, n_iter, seed)
+
+        assignments = _assign(vectors, centroids)
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+
+        return cls(
+            [node_ids[idx] for idx in order],
+            centroids,
+            list_offsets,
+            np.ascontiguousarray(vectors[order], dtype=dtype),
+            n_probe,
+        )
+
+    @classmethod
+    def from_embeddings(cls, embeddings, **kwargs):
+        """
+        Build the index of a {node: embedding} dict, see build for the keyword arguments.
+        """
+        node_ids = list(embeddings)
+        return cls.build(
+            node_ids,
+            np.stack([np.asarray(embeddings[node]).ravel() for node in node_ids]),
+            **kwargs,
+        )
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.node_ids) + len(self.added_ids)
+
+    def add(self, node_ids, matrix):
+        """
+        Insert new nodes into the lists of their most similar centroid, the centroids are kept.
+        """
+        vectors = NodeEmbeddingIndex.normalize(
+            np.asarray(matrix, dtype=np.float32).reshape(len(node_ids), -1)
+        )
+
+        self.added_ids.extend(node_ids)
+        self.added_vectors = np.concatenate([self.added_vectors, vectors])
+        self.added_lists = np.concatenate(
+            [self.added_lists, _assign(vectors, self.centroids)]
+        )
+
+    def _merged(self):
+        """
+        Return the node ids, list offsets and vectors with the added nodes merged into their lists.
+        """
+        if len(self.added_ids) == 0:
+            return self.node_ids, self.list_offsets, self.vectors
+
+        lists = np.concatenate(
+            [
+                np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets)),
+                self.added_lists,
+            ]
+        )
+        order = np.argsort(lists, kind="stable")
+        node_ids = self.node_ids + self.added_ids
+        vectors = np.concatenate(
+            [
+                np.asarray(self.vectors),
+                self.added_vectors.astype(self.vectors.dtype),
+            ]
+        )
+
+        list_offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=self.n_lists), out=list_offsets[1:])
+
+        return [node_ids[idx] for idx in order], list_offsets, vectors[order]
+
+    def save(self, directory):
+        """
+        Save the index with the added nodes merged into their lists.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        self.node_ids, self.list_offsets, self.vectors = self._merged()
+        self.added_ids = []
+        self.added_vectors = self.added_vectors[:0]
+        self.added_lists = self.added_lists[:0]
+
+        # Replacing the files keeps the arrays of a loaded index mapped to the old ones
+        for name in self.ARRAYS:
+            path = os.path.join(directory, f"{name}.npy")
+            with open(f"{path}.tmp", "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(f"{path}.tmp", path)
+
+        # The metadata is written last, a directory without it is incomplete
+        with open(os.path.join(directory, "meta.json.tmp"), "w") as f:
+            json.dump(
+                {
+                    "format_version": self.FORMAT_VERSION,
+                    "n_probe": self.n_probe,
+                    "node_ids": self.node_ids,
+                    "metadata": self.metadata,
+                },
+                f,
+            )
+        os.replace(
+            os.path.join(directory, "meta.json.tmp"),
+            os.path.join(directory, "meta.json"),
+        )
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, "meta.json"))
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Load a saved index, the vectors memory-mapped so a query only reads its probed lists.
+        """
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+
+        if meta["format_version"] != cls.FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported index format version {meta['format_version']} in {directory}."
+            )
+
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in cls.ARRAYS
+        }
+
+        return cls(
+            meta["node_ids"],
+            np.asarray(arrays["centroids"]),
+            np.asarray(arrays["list_offsets"]),
+            arrays["vectors"],
+            meta["n_probe"],
+            meta["metadata"],
+        )
+
+    def _search_one(self, query, k, n_probe):
+        probed = np.sort(top_k_positions(self.centroids @ query, n_probe))
+
+        # Lists are contiguous slices, scored without gathering their rows
+        rows, similarities = [], []
+        for idx in probed.tolist():
+            start, end = self.list_offsets[idx], self.list_offsets[idx + 1]
+            rows.append(np.arange(start, end))
+            similarities.append(
+                np.asarray(self.vectors[start:end], dtype=np.float32) @ query
+            )
+
+        # Added nodes get the rows following the stored ones
+        added = np.flatnonzero(np.isin(self.added_lists, probed))
+        rows.append(len(self.node_ids) + added)
+        similarities.append(self.added_vectors[added] @ query)
+
+        rows, similarities = np.concatenate(rows), np.concatenate(similarities)
+        if len(rows) == 0:
+            return []
+
+        results = []
+        for position in top_k_positions(similarities, k).tolist():
+            row = int(rows[position])
+            if row < len(self.node_ids):
+                node = self.node_ids[row]
+            else:
+                node = self.added_ids[row - len(self.node_ids)]
+            results.append((node, float(similarities[position])))
+
+        return results
+
+    def search(self, query_vectors, k=5, n_probe=None):
+        """
+        Return, for every query vector, its approximate k most similar (node, similarity) pairs.
+
+        Same interface as NodeEmbeddingIndex.search, n_probe defaults to the n_probe of the index.
+        """
+        if len(self) == 0 or k <= 0:
+            return [[] for _ in range(len(query_vectors))]
+
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        query_vectors = NodeEmbeddingIndex.normalize(
+            query_vectors.reshape(len(query_vectors), -1)
+        )
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+
+        return [self._search_one(query, k, n_probe) for query in query_vectors]
+
+
+def similar_node_pairs(index, nodes, similarity_threshold, k=10, batch_size=1024):
+    """
+    Return the (rows, cols) positions in nodes of the node pairs more similar than the threshold.
+
+    Every node is searched for its k nearest neighbours in index, so a node is paired with at most
+    k - 1 others. Like np.where on a similarity matrix, pairs come in both orders, row by row.
+    """
+    positions = {node: idx for idx, node in enumerate(nodes)}
+    node_ids, _, vectors = index._merged()
+    node_rows = [row for row, node in enumerate(node_ids) if node in positions]
+
+    pairs = set()
+    for start in range(0, len(node_rows), batch_size):
+        batch = node_rows[start : start + batch_size]
+        results = index.search(np.asarray(vectors[batch], dtype=np.float32), k)
+
+        for row, neighbors in zip(batch, results):
+            i = positions[node_ids[row]]
+            for node, similarity in neighbors:
+                j = positions.get(node)
+                if j is not None and i != j and similarity > similarity_threshold:
+                    pairs.add((i, j))
+                    pairs.add((j, i))
+
+    pairs = np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def recall_at_k(ann_index, exact_index, query_vectors, k=10, n_probe=None):
+    """
+    Benchmark ann_index against exact search on query_vectors.
+
+    Returns the mean fraction of the exact top k found by the ANN search, and the search time
+    per query of both indexes in milliseconds.
+    """
+    start = time.perf_counter()
+    exact = exact_index.search(query_vectors, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+    start = time.perf_counter()
+    approximate = ann_index.search(query_vectors, k, n_probe)
+    ann_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+    recalls = [
+        len({node for node, _ in found} & {node for node, _ in truth})
+        / max(1, len(truth))
+        for found, truth in zip(approximate, exact)
+    ]
+
+    return {
+        "recall": float(np.mean(recalls)),
+        "k": k,
+        "n_probe": n_probe or ann_index.n_probe,
+        "ann_ms_per_query": ann_ms,
+        "exact_ms_per_query": exact_ms,
+    }
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def top_k_positions(similarities, k):
+    """
+    Positions of the k largest similarities, best first, ties in position order.
+    """
+    k = min(k, len(similarities))
+    top = np.argpartition(-similarities, k - 1)[:k]
+    return top[np.lexsort((top, -similarities[top]))]
+
+
+class NodeEmbeddingIndex:
+    """
+    Exact cosine-similarity search over node embeddings stored as one L2-normalised matrix.
+
+    A batch of queries is answered with a single matrix product, and the top k of every query
+    are selected with argpartition before sorting.
+    """
+
+    def __init__(self, node_ids, matrix):
+        self.node_ids = list(node_ids)
+        self.matrix = self.normalize(np.asarray(matrix, dtype=np.float32))
+
+    @staticmethod
+    def normalize(vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        # Zero vectors stay zero, they have similarity 0 to everything
+        return np.ascontiguousarray(
+            vectors / np.maximum(norms, 1e-12), dtype=np.float32
+        )
+
+    @classmethod
+    def from_embeddings(cls, embeddings):
+        """
+        Build the index of a {node: embedding} dict, embeddings of any shape with dim elements.
+        """
+        node_ids = list(embeddings)
+        if len(node_ids) == 0:
+            return cls([], np.empty((0, 0), dtype=np.float32))
+
+        return cls(
+            node_ids,
+            np.stack([np.asarray(embeddings[node]).ravel() for node in node_ids]),
+        )
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def similarities(self, query_vectors):
+        """
+        Cosine similarities of the (n_queries, dim) query vectors to every node.
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        query_vectors = self.normalize(query_vectors.reshape(len(query_vectors), -1))
+
+        return query_vectors @ self.matrix.T
+
+    def search(self, query_vectors, k=5):
+        """
+        Return, for every query vector, its k most similar (node, similarity) pairs, best first.
+        """
+        if len(self) == 0 or k <= 0:
+            return [[] for _ in range(len(query_vectors))]
+
+        return [
+            [
+                (self.node_ids[idx], float(row[idx]))
+                for idx in top_k_positions(row, k).tolist()
+            ]
+            for row in self.similarities(query_vectors)
+        ]
+
+
+def node_embedding_index(embeddings):
+    """
+    Return the index to search for embeddings, an index or a {node: embedding} dict.
+
+    An index, exact or approximate like IVFIndex, is returned as is. A dict is indexed on every
+    call, callers searching the same embeddings repeatedly should build a NodeEmbeddingIndex once
+    and pass it instead.
+    """
+    if not isinstance(embeddings, dict):
+        return embeddings
+
+    return NodeEmbeddingIndex.from_embeddings(embeddings)
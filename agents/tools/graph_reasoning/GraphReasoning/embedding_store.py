@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+from GraphReasoning.embedding_index import NodeEmbeddingIndex, top_k_positions
+
+
+def embedding_checksum(node_ids, matrix, chunk_size=65536):
+    """
+    SHA-256 of the node id table and of the matrix bytes, read in chunks of chunk_size rows.
+    """
+    digest = hashlib.sha256(json.dumps(list(node_ids)).encode("utf-8"))
+    for start in range(0, len(matrix), chunk_size):
+        digest.update(np.ascontiguousarray(matrix[start : start + chunk_size]).data)
+    return digest.hexdigest()
+
+
+class EmbeddingStore(Mapping):
+    """
+    Read-only {node: embedding} mapping backed by one memory-mapped embedding matrix.
+
+    A store is a directory with embeddings.npy, the (n_nodes, dim) matrix as float16 or float32,
+    and meta.json with the node id of every row, the embedding model id and a checksum. Loading
+    reads meta.json only, rows are paged in on use. store[node] returns a (1, dim) float32 array
+    like the pickled dicts did.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, node_ids, matrix, model_id=None, checksum=None):
+        self.node_ids = list(node_ids)
+        self.matrix = matrix
+        self.model_id = model_id
+        self.checksum = checksum
+
+        self.rows = {node: row for row, node in enumerate(self.node_ids)}
+        self.norms = None
+
+    @classmethod
+    def save(cls, directory, node_ids, matrix, model_id=None, dtype=np.float16):
+        """
+        Write node_ids and their (n_nodes, dim) embedding matrix as a store, returning it loaded.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        node_ids = list(node_ids)
+        matrix = np.asarray(matrix)
+        matrix = np.ascontiguousarray(
+            matrix.reshape(len(node_ids), matrix.size // max(1, len(node_ids))),
+            dtype=dtype,
+        )
+
+        # Replacing the files keeps the matrix of a loaded store mapped to the old one
+        matrix_path = os.path.join(directory, "embeddings.npy")
+        with open(f"{matrix_path}.tmp", "wb") as f:
+            np.save(f, matrix)
+        os.replace(f"{matrix_path}.tmp", matrix_path)
+
+        # The metadata is written last, a directory without it is incomplete
+        with open(os.path.join(directory, "meta.json.tmp"), "w") as f:
+            json.dump(
+                {
+                    "format_version": cls.FORMAT_VERSION,
+                    "model_id": model_id,
+                    "dtype": matrix.dtype.name,
+                    "shape": list(matrix.shape),
+                    "checksum": embedding_checksum(node_ids, matrix),
+                    "node_ids": node_ids,
+                },
+                f,
+            )
+        os.replace(
+            os.path.join(directory, "meta.json.tmp"),
+            os.path.join(directory, "meta.json"),
+        )
+
+        return cls.load(directory)
+
+    @classmethod
+    def from_embeddings(cls, directory, embeddings, model_id=None, dtype=np.float16):
+        """
+        Write a {node: embedding} dict as a store, returning it loaded.
+        """
+        node_ids = list(embeddings)
+        if len(node_ids) == 0:
+            matrix = np.empty((0, 0), dtype=dtype)
+        else:
+            matrix = np.stack(
+                [np.asarray(embeddings[node]).ravel() for node in node_ids]
+            )
+
+        return cls.save(directory, node_ids, matrix, model_id, dtype)
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, "meta.json"))
+
+    @classmethod
+    def load(cls, directory, model_id=None, verify=False, mmap_mode="r"):
+        """
+        Open a store with its matrix memory-mapped.
+
+        Raises ValueError if the format version, the model id when given, or the matrix shape does
+        not match, and with verify=True if the checksum does not either.
+        """
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+
+        if meta["format_version"] != cls.FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported embedding store format version {meta['format_version']} in {directory}."
+            )
+        if model_id is not None and meta["model_id"] != model_id:
+            raise ValueError(
+                f"Embeddings in {directory} were computed with {meta['model_id']}, not {model_id}."
+            )
+
+        matrix = np.load(os.path.join(directory, "embeddings.npy"), mmap_mode=mmap_mode)
+        if list(matrix.shape) != meta["shape"] or matrix.dtype.name != meta["dtype"]:
+            raise ValueError(
+                f"Embedding matrix of {directory} does not match meta.json."
+            )
+
+        store = cls(meta["node_ids"], matrix, meta["model_id"], meta["checksum"])
+        if verify and not store.verify():
+            raise ValueError(f"Checksum mismatch for the embeddings in {directory}.")
+
+        return store
+
+    def verify(self):
+        return embedding_checksum(self.node_ids, self.matrix) == self.checksum
+
+    def __getitem__(self, node):
+        row = self.rows[node]
+        return np.asarray(self.matrix[row : row + 1], dtype=np.float32)
+
+    def __iter__(self):
+        return iter(self.node_ids)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def __contains__(self, node):
+        return node in self.rows
+
+    def to_dict(self):
+        return {node: self[node] for node in self.node_ids}
+
+    def similarities(self, query_vectors, chunk_size=65536):
+        """
+        Cosine similarities of the (n_queries, dim) query vectors to every node.
+
+        The matrix is scored in chunks of chunk_size rows, so it is never copied whole.
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        query_vectors = NodeEmbeddingIndex.normalize(
+            query_vectors.reshape(len(query_vectors), -1)
+        )
+
+        if self.norms is None:
+            self.norms = np.concatenate(
+                [
+                    np.linalg.norm(
+                        np.asarray(self.matrix[start : start + chunk_size], np.float32),
+                        axis=1,
+                    )
+                    for start in range(0, len(self), chunk_size)
+                ]
+            )
+
+        similarities = np.empty((len(query_vectors), len(self)), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            chunk = np.asarray(self.matrix[start : start + chunk_size], np.float32)
+            similarities[:, start : start + len(chunk)] = query_vectors @ chunk.T
+
+        return similarities / np.maximum(self.norms, 1e-12)
+
+    def search(self, query_vectors, k=5):
+        """
+        Same as NodeEmbeddingIndex.search, scored on the stored matrix.
+        """
+        if len(self) == 0 or k <= 0:
+            return [[] for _ in range(len(query_vectors))]
+
+        return [
+            [
+                (self.node_ids[idx], float(row[idx]))
+                for idx in top_k_positions(row, k).tolist()
+            ]
+            for row in self.similarities(query_vectors)
+        ]
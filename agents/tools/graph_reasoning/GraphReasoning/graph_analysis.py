@@ -54,12 +54,11 @@ def heuristic_path_with_embeddings(
 
     if verbatim:
         print("Original: ", source, "-->", target)
-    source = find_best_fitting_node_list(
-        source, node_embeddings, embedding_tokenizer, embedding_model, 5
-    )[0][0].strip()
-    target = find_best_fitting_node_list(
-        target, node_embeddings, embedding_tokenizer, embedding_model, 5
-    )[0][0].strip()
+    source_list, target_list = find_best_fitting_nodes(
+        [source, target], node_embeddings, embedding_tokenizer, embedding_model, 5
+    )
+    source = source_list[0][0].strip()
+    target = target_list[0][0].strip()
 
     # if verbatim:
     print("Selected: ", source, "-->", target)
@@ -301,26 +300,23 @@ def find_path(
     save_files=True,
 ):
 
-    best_node_1, best_similarity_1 = find_best_fitting_node_list(
-        keyword_1,
+    # Both keywords are resolved in one batch
+    best_nodes_1, best_nodes_2 = find_best_fitting_nodes(
+        [keyword_1, keyword_2],
         node_embeddings,
         tokenizer,
         model,
-        max(5, similarity_fit_ID_node_1 + 1),
-    )[similarity_fit_ID_node_1]
+        max(5, similarity_fit_ID_node_1 + 1, similarity_fit_ID_node_2 + 1),
+    )
+
+    best_node_1, best_similarity_1 = best_nodes_1[similarity_fit_ID_node_1]
 
     if verbatim:
         print(
             f"{similarity_fit_ID_node_1}nth best fitting node for '{keyword_1}': '{best_node_1}' with similarity: {best_similarity_1}"
         )
 
-    best_node_2, best_similarity_2 = find_best_fitting_node_list(
-        keyword_2,
-        node_embeddings,
-        tokenizer,
-        model,
-        max(5, similarity_fit_ID_node_2 + 1),
-    )[similarity_fit_ID_node_2]
+    best_node_2, best_similarity_2 = best_nodes_2[similarity_fit_ID_node_2]
     if verbatim:
         print(
             f"{similarity_fit_ID_node_2}nth best fitting node for '{keyword_2}': '{best_node_2}' with similarity: {best_similarity_2}"
@@ -2135,11 +2131,8 @@ def heuristic_path_with_embeddings_with_randomization_waypoints(
 
     if verbatim:
         print("Original: ", source, "-->", target)
-    source_list = find_best_fitting_node_list(
-        source, node_embeddings, embedding_tokenizer, embedding_model, 5
-    )
-    target_list = find_best_fitting_node_list(
-        target, node_embeddings, embedding_tokenizer, embedding_model, 5
+    source_list, target_list = find_best_fitting_nodes(
+        [source, target], node_embeddings, embedding_tokenizer, embedding_model, 5
     )
 
     if not source_list or not target_list:
@@ -1,6 +1,7 @@
 import copy
 import heapq
 import json
+import multiprocessing
 import os
 import pickle
 import random
@@ -13,6 +14,7 @@ import networkx as nx
 import numpy as np
 import pandas as pd
 import seaborn as sns
+import torch
 from powerlaw import Fit
 from pyvis.network import Network
 from scipy.spatial import Voronoi, voronoi_plot_2d
@@ -25,84 +27,187 @@ from tqdm import tqdm
 from tqdm.notebook import tqdm
 from transformers import logging
 
+from GraphReasoning.ann_index import IVFIndex, similar_node_pairs
+from GraphReasoning.embedding_index import NodeEmbeddingIndex, node_embedding_index
+from GraphReasoning.embedding_store import EmbeddingStore
+
 palette = "hls"
 logging.set_verbosity_error()
 
 
-# Function to generate embeddings
-def generate_node_embeddings(graph, tokenizer, model):
-    embeddings = {}
-    for node in tqdm(graph.nodes()):
-        inputs = tokenizer(str(node), return_tensors="pt")
-        outputs = model(**inputs)
-        embeddings[node] = outputs.last_hidden_state.mean(dim=1).detach().numpy()
+# Tokenizer, model and batch size inherited by forked embedding workers
+_EMBEDDING_WORKER_STATE = {}
+
+
+def _embed_sorted_texts(texts, tokenizer, model, batch_size, show_progress=True):
+    """
+    Mean-pooled embeddings of texts already sorted by length, one padded batch at a time.
+    """
+    device = next(model.parameters()).device
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+
+    starts = range(0, len(texts), batch_size)
+    for start in tqdm(starts) if show_progress else starts:
+        inputs = tokenizer(
+            texts[start : start + batch_size],
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+        )
+        inputs = {k: v.to(device) for k, v in inputs.items()}
+
+        with torch.inference_mode():
+            outputs = model(**inputs)
+
+        # Mean over the real tokens only, as for an unpadded single text
+        mask = (
+            inputs["attention_mask"].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+        )
+        pooled = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1)
+        embeddings[start : start + len(pooled)] = pooled.float().cpu().numpy()
+
     return embeddings
 
 
-def save_embeddings(embeddings, file_path):
-    with open(file_path, "wb") as f:
-        pickle.dump(embeddings, f)
+def _init_embedding_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _embed_shard(texts):
+    return _embed_sorted_texts(
+        texts,
+        _EMBEDDING_WORKER_STATE["tokenizer"],
+        _EMBEDDING_WORKER_STATE["model"],
+        _EMBEDDING_WORKER_STATE["batch_size"],
+        show_progress=False,
+    )
+
+
+def embed_texts(
+    texts, tokenizer, model, batch_size=32, num_workers=1, show_progress=True
+):
+    """
+    Embed texts as a contiguous (len(texts), hidden size) float32 matrix, in the order of texts.
+
+    Texts are sorted by length so each padded batch wastes little padding. With num_workers > 1,
+    the sorted texts are split into shards embedded by forked CPU processes sharing the cores.
+    """
+    texts = [str(text) for text in texts]
+    order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+    sorted_texts = [texts[idx] for idx in order]
+
+    use_processes = (
+        num_workers > 1
+        and len(texts) > batch_size
+        and "fork" in multiprocessing.get_all_start_methods()
+        and next(model.parameters()).device.type == "cpu"
+    )
+
+    if not use_processes:
+        sorted_embeddings = _embed_sorted_texts(
+            sorted_texts, tokenizer, model, batch_size, show_progress
+        )
+    else:
+        # Interleaved shards get a similar mix of short and long texts
+        shards = [sorted_texts[worker::num_workers] for worker in range(num_workers)]
+
+        _EMBEDDING_WORKER_STATE.update(
+            tokenizer=tokenizer, model=model, batch_size=batch_size
+        )
+        try:
+            with multiprocessing.get_context("fork").Pool(
+                num_workers,
+                initializer=_init_embedding_worker,
+                initargs=(max(1, (os.cpu_count() or 1) // num_workers),),
+            ) as pool:
+                shard_embeddings = pool.map(_embed_shard, shards)
+        finally:
+            _EMBEDDING_WORKER_STATE.clear()
+
+        sorted_embeddings = np.empty(
+            (len(texts), model.config.hidden_size), dtype=np.float32
+        )
+        for worker, embeddings in enumerate(shard_embeddings):
+            sorted_embeddings[worker::num_workers] = embeddings
 
+    embeddings = np.empty_like(sorted_embeddings)
+    embeddings[order] = sorted_embeddings
 
-def load_embeddings(file_path):
-    with open(file_path, "rb") as f:
-        embeddings = pickle.load(f)
     return embeddings
 
 
+def generate_node_embedding_matrix(
+    nodes, tokenizer, model, batch_size=32, num_workers=1
+):
+    """
+    Return the node ids and their embeddings as a contiguous float32 matrix with aligned rows.
+    """
+    node_ids = list(nodes)
+    return node_ids, embed_texts(node_ids, tokenizer, model, batch_size, num_workers)
+
+
+def embeddings_from_matrix(node_ids, matrix):
+    """
+    {node: (1, dim) embedding} view of an embedding matrix, sharing its memory.
+    """
+    return {node: matrix[idx : idx + 1] for idx, node in enumerate(node_ids)}
+
+
+# Function to generate embeddings
+def generate_node_embeddings(graph, tokenizer, model, batch_size=32, num_workers=1):
+    node_ids, matrix = generate_node_embedding_matrix(
+        graph.nodes(), tokenizer, model, batch_size, num_workers
+    )
+    return embeddings_from_matrix(node_ids, matrix)
+
+
+def save_embeddings(embeddings, file_path, model_id=None, dtype=np.float16):
+    """
+    Write a {node: embedding} dict as an EmbeddingStore directory at file_path and return it.
+    """
+    return EmbeddingStore.from_embeddings(file_path, embeddings, model_id, dtype)
+
+
+def load_embeddings(file_path, model_id=None):
+    """
+    Open the EmbeddingStore at file_path, its matrix memory-mapped.
+
+    A file_path that is a file is read as a legacy pickled dict, only load trusted pickles.
+    """
+    if os.path.isfile(file_path):
+        with open(file_path, "rb") as f:
+            embeddings = pickle.load(f)
+        return embeddings
+
+    return EmbeddingStore.load(file_path, model_id)
+
+
+def find_best_fitting_nodes(keywords, embeddings, tokenizer, model, N_samples=5):
+    """
+    Return the N_samples (node, similarity) pairs closest to every keyword, best first.
+
+    embeddings is a {node: embedding} dict, a NodeEmbeddingIndex or an IVFIndex. All keywords are
+    embedded in one batch and searched together.
+    """
+    keyword_embeddings = embed_texts(keywords, tokenizer, model, show_progress=False)
+
+    return node_embedding_index(embeddings).search(keyword_embeddings, N_samples)
+
+
 def find_best_fitting_node(keyword, embeddings, tokenizer, model):
-    inputs = tokenizer(keyword, return_tensors="pt")
-    outputs = model(**inputs)
-    keyword_embedding = (
-        outputs.last_hidden_state.mean(dim=1).detach().numpy().flatten()
-    )  # Flatten to ensure 1-D
-
-    # Calculate cosine similarity and find the best match
-    best_node = None
-    best_similarity = float("-inf")  # Initialize with negative infinity
-    for node, embedding in embeddings.items():
-        # Ensure embedding is 1-D
-        embedding = embedding.flatten()  # Flatten to ensure 1-D
-        similarity = 1 - cosine(keyword_embedding, embedding)  # Cosine similarity
-        if similarity > best_similarity:
-            best_similarity = similarity
-            best_node = node
-
-    return best_node, best_similarity
+    best_nodes = find_best_fitting_nodes([keyword], embeddings, tokenizer, model, 1)[0]
 
+    if len(best_nodes) == 0:
+        return None, float("-inf")
 
-def find_best_fitting_node_list(keyword, embeddings, tokenizer, model, N_samples=5):
-    inputs = tokenizer(keyword, return_tensors="pt")
-    outputs = model(**inputs)
-    keyword_embedding = (
-        outputs.last_hidden_state.mean(dim=1).detach().numpy().flatten()
-    )  # Flatten to ensure 1-D
-
-    # Initialize a min-heap
-    min_heap = []
-    heapq.heapify(min_heap)
-
-    for node, embedding in embeddings.items():
-        # Ensure embedding is 1-D
-        embedding = embedding.flatten()  # Flatten to ensure 1-D
-        similarity = 1 - cosine(keyword_embedding, embedding)  # Cosine similarity
-
-        # If the heap is smaller than N_samples, just add the current node and similarity
-        if len(min_heap) < N_samples:
-            heapq.heappush(min_heap, (similarity, node))
-        else:
-            # If the current similarity is greater than the smallest similarity in the heap
-            if similarity > min_heap[0][0]:
-                heapq.heappop(min_heap)  # Remove the smallest
-                heapq.heappush(
-                    min_heap, (similarity, node)
-                )  # Add the current node and similarity
+    return best_nodes[0]
 
-    # Convert the min-heap to a sorted list in descending order of similarity
-    best_nodes = sorted(min_heap, key=lambda x: -x[0])
 
+def find_best_fitting_node_list(keyword, embeddings, tokenizer, model, N_samples=5):
     # Return a list of tuples (node, similarity)
-    return [(node, similarity) for similarity, node in best_nodes]
+    return find_best_fitting_nodes([keyword], embeddings, tokenizer, model, N_samples)[
+        0
+    ]
 
 
 # Example usage
@@ -653,6 +758,8 @@ def update_node_embeddings(
     model,
     remove_embeddings_for_nodes_no_longer_in_graph=True,
     verbatim=False,
+    batch_size=32,
+    num_workers=1,
 ):
     """
     Update embeddings for new nodes in an updated graph, ensuring that the original embeddings are not altered.
@@ -662,25 +769,31 @@ def update_node_embeddings(
     - graph_new: The updated graph object.
     - tokenizer: Tokenizer object to tokenize node names.
     - model: Model object to generate embeddings.
+    - batch_size, num_workers: Batching and process sharding of the new nodes, see embed_texts.
 
     Returns:
     - Updated embeddings dictionary with embeddings for new nodes, without altering the original embeddings.
     """
-    # Create a deep copy of the original embeddings
-    embeddings_updated = copy.deepcopy(embeddings)
+    # Create a deep copy of the original embeddings, a read-only store is copied into a dict
+    if isinstance(embeddings, EmbeddingStore):
+        embeddings_updated = embeddings.to_dict()
+    else:
+        embeddings_updated = copy.deepcopy(embeddings)
 
-    # Iterate through new graph nodes
-    for node in tqdm(graph_new.nodes()):
-        # Check if the node already has an embedding in the copied dictionary
-        if node not in embeddings_updated:
-            if verbatim:
-                print(f"Generating embedding for new node: {node}")
-            inputs = tokenizer(node, return_tensors="pt")
-            outputs = model(**inputs)
-            # Update the copied embeddings dictionary with the new node's embedding
-            embeddings_updated[node] = (
-                outputs.last_hidden_state.mean(dim=1).detach().numpy()
+    # New graph nodes, without an embedding in the copied dictionary
+    new_nodes = [node for node in graph_new.nodes() if node not in embeddings_updated]
+    if verbatim:
+        for node in new_nodes:
+            print(f"Generating embedding for new node: {node}")
+
+    # Update the copied embeddings dictionary with the new nodes' embeddings
+    embeddings_updated.update(
+        embeddings_from_matrix(
+            *generate_node_embedding_matrix(
+                new_nodes, tokenizer, model, batch_size, num_workers
             )
+        )
+    )
 
     if remove_embeddings_for_nodes_no_longer_in_graph:
         # Remove embeddings for nodes that no longer exist in the graph from the copied dictionary
@@ -725,6 +838,25 @@ def simplify_node_name_with_llm(node_name, generate, max_tokens=2048, temperatur
     return simplified_name
 
 
+def similar_nodes(node_embeddings, nodes, similarity_threshold, ann_index=None):
+    """
+    Return the (rows, cols) positions in nodes of the node pairs more similar than the threshold.
+
+    Without ann_index, the full cosine similarity matrix of the nodes is computed. With an IVFIndex,
+    or True to build one from node_embeddings, only the nearest neighbours of every node are compared.
+    """
+    if ann_index is None:
+        embeddings_matrix = np.array(
+            [node_embeddings[node].flatten() for node in nodes]
+        )
+        return np.where(cosine_similarity(embeddings_matrix) > similarity_threshold)
+
+    if ann_index is True:
+        ann_index = IVFIndex.from_embeddings(node_embeddings)
+
+    return similar_node_pairs(ann_index, nodes, similarity_threshold)
+
+
 def simplify_graph_simple(
     graph_,
     node_embeddings,
@@ -738,13 +870,11 @@ def simplify_graph_simple(
     max_tokens=2048,
     temperature=0.3,
     generate=None,
+    ann_index=None,
 ):
     graph = graph_.copy()
     nodes = list(node_embeddings.keys())
-    embeddings_matrix = np.array([node_embeddings[node].flatten() for node in nodes])
-
-    similarity_matrix = cosine_similarity(embeddings_matrix)
-    to_merge = np.where(similarity_matrix > similarity_threshold)
+    to_merge = similar_nodes(node_embeddings, nodes, similarity_threshold, ann_index)
 
     node_mapping = {}
     nodes_to_recalculate = set()
@@ -803,16 +933,17 @@ def simplify_node_name_with_llm(node_name, max_tokens, temperature):
     return node_name
 
 
-def regenerate_node_embeddings(graph, nodes_to_recalculate, tokenizer, model):
+def regenerate_node_embeddings(
+    graph, nodes_to_recalculate, tokenizer, model, batch_size=32, num_workers=1
+):
     """
     Regenerate embeddings for specific nodes.
     """
-    new_embeddings = {}
-    for node in tqdm(nodes_to_recalculate):
-        inputs = tokenizer(node, return_tensors="pt")
-        outputs = model(**inputs)
-        new_embeddings[node] = outputs.last_hidden_state.mean(dim=1).detach().numpy()
-    return new_embeddings
+    return embeddings_from_matrix(
+        *generate_node_embedding_matrix(
+            nodes_to_recalculate, tokenizer, model, batch_size, num_workers
+        )
+    )
 
 
 def simplify_graph(
@@ -828,6 +959,7 @@ def simplify_graph(
     max_tokens=2048,
     temperature=0.3,
     generate=None,
+    ann_index=None,
 ):
     """
     Simplifies a graph by merging similar nodes and optionally renaming them using a language model.
@@ -836,10 +968,7 @@ def simplify_graph(
     graph = graph_.copy()
 
     nodes = list(node_embeddings.keys())
-    embeddings_matrix = np.array([node_embeddings[node].flatten() for node in nodes])
-
-    similarity_matrix = cosine_similarity(embeddings_matrix)
-    to_merge = np.where(similarity_matrix > similarity_threshold)
+    to_merge = similar_nodes(node_embeddings, nodes, similarity_threshold, ann_index)
 
     node_mapping = {}
     nodes_to_recalculate = set()
@@ -1228,18 +1357,6 @@ def make_graph_from_text_withtext(
     return G_total
 
 
-def regenerate_node_embeddings(graph, nodes_to_recalculate, tokenizer, model):
-    """
-    Regenerate embeddings for specific nodes.
-    """
-    new_embeddings = {}
-    for node in tqdm(nodes_to_recalculate):
-        inputs = tokenizer(node, return_tensors="pt")
-        outputs = model(**inputs)
-        new_embeddings[node] = outputs.last_hidden_state.mean(dim=1).detach().numpy()
-    return new_embeddings
-
-
 def simplify_graph_with_text(
     graph_,
     node_embeddings,
@@ -1253,6 +1370,7 @@ def simplify_graph_with_text(
     max_tokens=2048,
     temperature=0.3,
     generate=None,
+    ann_index=None,
 ):
     """
     Simplifies a graph by merging similar nodes and optionally renaming them using a language model.
@@ -1262,10 +1380,7 @@ def simplify_graph_with_text(
     graph = deepcopy(graph_)
 
     nodes = list(node_embeddings.keys())
-    embeddings_matrix = np.array([node_embeddings[node].flatten() for node in nodes])
-
-    similarity_matrix = cosine_similarity(embeddings_matrix)
-    to_merge = np.where(similarity_matrix > similarity_threshold)
+    to_merge = similar_nodes(node_embeddings, nodes, similarity_threshold, ann_index)
 
     node_mapping = {}
     nodes_to_recalculate = set()
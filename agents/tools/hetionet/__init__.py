@@ -1,3 +1,4 @@
+import itertools
 import json
 import os
 import pickle
@@ -5,111 +6,237 @@ import sys
 
 import networkx as nx
 import pandas as pd
-from tqdm import tqdm
-
-from core.utils import LOGGER, find_least_levenshtein_distance, match_name
 
 cwd_path = os.path.dirname(os.path.realpath(__file__))
-sys.path.append(f"{cwd_path}/../../")
+sys.path.append(f"{cwd_path}/../../../")
 
-# Generate NetworkX graph
-if os.path.exists(f"{cwd_path}/data/nx_graph.pkl"):
-    G = pickle.load(open(f"{cwd_path}/data/nx_graph.pkl", "rb"))
-else:
-    LOGGER.log_with_depth("Data not found. Generating NetworkX graph...")
-    # Read Hetionet v1.0
-    fpath = "data/hetionet-v1.0.json"
+from agents.tools.hetionet.csr_graph import CSRGraph
+from agents.tools.hetionet.metapaths import MetapathIndex
+from agents.tools.hetionet.paths import iter_ranked_paths
+from core.resources import lazy_resource
+from core.utils import LOGGER, NameMatcher, match_name
+
+HETIONET_BUILD_VERSION = 2
+
+# Paths returned by retrieval_hetionet, the best ranked ones are kept
+MAX_PATHS = 50
 
+HETIONET_NODE_KINDS = [
+    "Side Effect",
+    "Compound",
+    "Symptom",
+    "Anatomy",
+    "Pharmacologic Class",
+    "Disease",
+]
+
+
+def load_hetionet_tables(fpath):
+    """
+    Read the Hetionet JSON into a node table and an edge table filtered to HETIONET_NODE_KINDS.
+
+    Edge endpoints are resolved to node names with one merge against the (kind, id) -> name index.
+    """
     with open(fpath, "r") as f:
         hetio_json = json.load(f)
 
     # Nodes
-    node_rows = []
-    for idx, node in enumerate(hetio_json["nodes"]):
-        node_kind = node["kind"].lower()
-        node_id = node["identifier"]
-        node_name = node["name"].lower()
+    node_df = pd.DataFrame(
+        {
+            "kind": [node["kind"].lower() for node in hetio_json["nodes"]],
+            "id": [node["identifier"] for node in hetio_json["nodes"]],
+            "name": [node["name"].lower() for node in hetio_json["nodes"]],
+        }
+    )
+    LOGGER.log_with_depth(f"Node Kind: {node_df['kind'].value_counts()}")
+
+    # Edges
+    edges = hetio_json["edges"]
+    edge_df = pd.DataFrame(
+        {
+            "kind": [edge["kind"].lower() for edge in edges],
+            "source_kind": [edge["source_id"][0] for edge in edges],
+            "source_id": [edge["source_id"][1] for edge in edges],
+            "target_kind": [edge["target_id"][0] for edge in edges],
+            "target_id": [edge["target_id"][1] for edge in edges],
+            "direction": [edge["direction"] for edge in edges],
+        }
+    )
+    del hetio_json, edges
+
+    edge_df = edge_df[
+        edge_df["source_kind"].isin(HETIONET_NODE_KINDS)
+        & edge_df["target_kind"].isin(HETIONET_NODE_KINDS)
+    ].reset_index(drop=True)
+    edge_df["source_kind"] = edge_df["source_kind"].str.lower()
+    edge_df["target_kind"] = edge_df["target_kind"].str.lower()
+
+    # Resolve both endpoints against the (kind, id) -> name index
+    name_index = node_df.drop_duplicates(["kind", "id"])
+    for end in ["source", "target"]:
+        edge_df = edge_df.merge(
+            name_index.rename(
+                columns={
+                    "kind": f"{end}_kind",
+                    "id": f"{end}_id",
+                    "name": f"{end}_name",
+                }
+            ),
+            on=[f"{end}_kind", f"{end}_id"],
+            how="left",
+            validate="many_to_one",
+        )
+
+    unresolved = edge_df["source_name"].isna() | edge_df["target_name"].isna()
+    if unresolved.any():
+        raise ValueError(f"{unresolved.sum()} Hetionet edges have an unknown endpoint.")
+
+    return node_df, edge_df
 
-        node_rows.append([node_kind, node_id, node_name])
 
-    node_df = pd.DataFrame(node_rows, columns=["kind", "id", "name"])
+def build_hetionet_graph(
+    fpath=f"{cwd_path}/data/hetionet-v1.0.json", output_dir=f"{cwd_path}/data"
+):
+    LOGGER.log_with_depth("Data not found. Generating NetworkX graph...")
+
+    # Read Hetionet v1.0
+    node_df, edge_df = load_hetionet_tables(fpath)
 
     LOGGER.log_with_depth(node_df)
-    node_df.to_csv(f"{cwd_path}/data/nodes.csv", sep="\t", index=False)
+    node_df.to_csv(f"{output_dir}/nodes.csv", sep="\t", index=False)
+    LOGGER.log_with_depth(edge_df)
+    edge_df.to_csv(f"{output_dir}/edges.csv", sep="\t", index=False)
 
-    LOGGER.log_with_depth(f"Node Kind: {node_df['kind'].value_counts()}")
+    # Create NetworkX graph
+    G = nx.Graph()
+    G.add_nodes_from(
+        (name, {"kind": kind}) for name, kind in zip(node_df["name"], node_df["kind"])
+    )
+    G.add_edges_from(
+        (source_name, target_name, {"kind": kind})
+        for source_name, target_name, kind in zip(
+            edge_df["source_name"], edge_df["target_name"], edge_df["kind"]
+        )
+    )
 
-    # Edges
-    edge_rows = []
-    filter_kind = [
-        "Side Effect",
-        "Compound",
-        "Symptom",
-        "Anatomy",
-        "Pharmacologic Class",
-        "Disease",
-    ]
-
-    for idx, edge in enumerate(hetio_json["edges"]):
-        edge_kind = edge["kind"].lower()
-        edge_source_kind, edge_source_id = edge["source_id"]
-        edge_target_kind, edge_target_id = edge["target_id"]
-        edge_direction = edge["direction"]
-
-        if edge_source_kind not in filter_kind or edge_target_kind not in filter_kind:
-            continue
+    with open(f"{output_dir}/nx_graph.pkl", "wb") as f:
+        pickle.dump(G, f)
 
-        edge_source_kind, edge_target_kind = (
-            edge_source_kind.lower(),
-            edge_target_kind.lower(),
+    # Written last, describes the artifacts above
+    with open(f"{output_dir}/hetionet_build.json", "w") as f:
+        json.dump(
+            {
+                "build_version": HETIONET_BUILD_VERSION,
+                "source": os.path.basename(fpath),
+                "nodes": G.number_of_nodes(),
+                "edges": G.number_of_edges(),
+                "tables": ["nodes.csv", "edges.csv"],
+                "graph": "nx_graph.pkl",
+            },
+            f,
+            indent=2,
         )
 
-        edge_rows.append(
-            [
-                edge_kind,
-                edge_source_kind,
-                edge_source_id,
-                edge_target_kind,
-                edge_target_id,
-                edge_direction,
-            ]
+    return G
+
+
+def load_nx_graph():
+    if os.path.exists(f"{cwd_path}/data/nx_graph.pkl"):
+        with open(f"{cwd_path}/data/nx_graph.pkl", "rb") as f:
+            return pickle.load(f)
+
+    return build_hetionet_graph()
+
+
+def hetionet_build_info(output_dir=f"{cwd_path}/data"):
+    """
+    The hetionet_build.json written with nx_graph.pkl, None for a graph built before it existed.
+    """
+    if not os.path.exists(f"{output_dir}/hetionet_build.json"):
+        return None
+
+    with open(f"{output_dir}/hetionet_build.json", "r") as f:
+        return json.load(f)
+
+
+@lazy_resource("hetionet")
+def hetionet():
+    csr_path = f"{cwd_path}/data/hetionet_csr"
+
+    G = CSRGraph.load(csr_path) if CSRGraph.exists(csr_path) else None
+
+    # The CSR copy records the build it was converted from, a rebuilt graph is converted again
+    if G is None or G.metadata.get("hetionet_build") != hetionet_build_info():
+        LOGGER.log_with_depth("Converting the NetworkX graph to CSR...")
+        G = CSRGraph.from_networkx(load_nx_graph())
+        G.metadata["hetionet_build"] = hetionet_build_info()
+        G.save(csr_path)
+        G = CSRGraph.load(csr_path)
+
+    return G, NameMatcher(G.nodes)
+
+
+@lazy_resource("hetionet_metapaths")
+def hetionet_metapaths():
+    """
+    The precomputed compound -> disease metapath index, None if it was not built.
+    """
+    index_path = f"{cwd_path}/data/metapath_index"
+
+    if not MetapathIndex.exists(index_path):
+        return None
+
+    index = MetapathIndex(index_path)
+
+    if index.format_version != MetapathIndex.FORMAT_VERSION:
+        LOGGER.log_with_depth(
+            "Warning: the metapath index has an old format, rebuild it."
         )
+        return None
 
-    edge_df = pd.DataFrame(
-        edge_rows,
-        columns=[
-            "kind",
-            "source_kind",
-            "source_id",
-            "target_kind",
-            "target_id",
-            "direction",
-        ],
-    )
-    LOGGER.log_with_depth(edge_df)
-    edge_df.to_csv(f"{cwd_path}/data/edges.csv", sep="\t", index=False)
+    # Paths are stored as node ids, an index of another graph build is unusable
+    G, _ = hetionet()
+    if index.manifest.get("graph_fingerprint") != G.fingerprint():
+        LOGGER.log_with_depth(
+            "Warning: the metapath index was built from another graph, rebuild it."
+        )
+        return None
 
-    # Create NetworkX graph
-    get_name = lambda node_kind, node_id: node_df[
-        (node_df["kind"] == node_kind) & (node_df["id"] == node_id)
-    ]["name"].values[0]
+    return index
 
-    G = nx.Graph()
 
-    for idx, node in node_df.iterrows():
-        G.add_node(node["name"], kind=node["kind"])
+def indexed_paths(G, metapaths, entry, cutoff):
+    """
+    Yield the (node ids, edge kind codes) of the metapath instances of an index entry, shortest first.
+    """
+    for metapath, (_, edge_kinds) in sorted(
+        metapaths.items(), key=lambda item: len(item[1][1])
+    ):
+        if metapath not in entry or len(edge_kinds) > cutoff:
+            continue
+
+        kinds = [G.edge_kind_names.index(kind) for kind in edge_kinds]
+        for path in entry[metapath]["paths"]:
+            yield path, kinds
 
-    for idx, edge in tqdm(edge_df.iterrows(), total=edge_df.shape[0]):
-        source_name = get_name(edge["source_kind"], edge["source_id"])
-        target_name = get_name(edge["target_kind"], edge["target_id"])
 
-        G.add_edge(source_name, target_name, kind=edge["kind"])
+def format_path(G, path, kinds):
+    single_path = [f"<drug>{G.node_kind(path[0])}:{G.node_names[path[0]]}</drug>"]
 
-    with open(f"{cwd_path}/data/nx_graph.pkl", "wb") as f:
-        pickle.dump(G, f)
+    for end_node, kind in zip(path[1:], kinds):
+        single_path.append(
+            f"<edge>{G.edge_kind_names[kind]}</edge><drug>{G.node_kind(end_node)}:{G.node_names[end_node]}</drug>"
+        )
+
+    return f"<path>{''.join(single_path)}</path>"
 
 
-def retrieval_hetionet(source_name, target_name, cutoff=2):
+def retrieval_hetionet(
+    source_name, target_name, cutoff=2, max_paths=MAX_PATHS, use_index=True
+):
+    G, node_matcher = hetionet()
+    metapath_index = hetionet_metapaths() if use_index else None
+
     try:
         # Function to list all paths with length < 3 (cutoff = 2)
         source_name, target_name = (
@@ -118,42 +245,52 @@ def retrieval_hetionet(source_name, target_name, cutoff=2):
         )
 
         # Match similar names
-        source_name = match_name(source_name, G.nodes)
-        target_name, distance = find_least_levenshtein_distance(target_name, G.nodes)
-
-        all_paths = list(
-            nx.all_simple_paths(
-                G, source=source_name, target=target_name, cutoff=cutoff
+        source_name = match_name(source_name, node_matcher)
+        target_name, distance = node_matcher.match(target_name)
+
+        # Answer from the metapath index when it covers the pair, walk the graph otherwise
+        index_entry = None
+        if metapath_index is not None and cutoff <= metapath_index.max_length:
+            index_entry = metapath_index.lookup(source_name, target_name)
+
+        metapath_counts = ""
+        truncated = False
+        if index_entry is not None:
+            # The index holds every compound -> disease metapath up to its max_length
+            metapaths = metapath_index.metapaths
+            ranked_paths = indexed_paths(G, metapaths, index_entry, cutoff)
+
+            counts = {
+                metapath: entry["count"]
+                for metapath, entry in index_entry.items()
+                if len(metapaths[metapath][1]) <= cutoff
+            }
+            metapath_counts = f"Metapath counts: {', '.join(f'{metapath}={count}' for metapath, count in counts.items())}\n"
+            truncated = any(
+                index_entry[metapath]["count"] > len(index_entry[metapath]["paths"])
+                for metapath in counts
+            )
+        else:
+            ranked_paths = iter_ranked_paths(
+                G, G.name_to_id[source_name], G.name_to_id[target_name], cutoff=cutoff
             )
-        )
-
-        final_path_str = (
-            f"All paths from {source_name} to {target_name} with length < {cutoff+1}:\n"
-        )
-
-        path_list = []
-        for path in all_paths:
-            single_path = []
-            for i in range(len(path) - 1):
-                start_node = path[i]
-                end_node = path[i + 1]
-
-                edge_kind = G[start_node][end_node].get("kind", "Unknown relation")
-                start_node_kind = G.nodes[start_node].get("kind", "Unknown kind")
-                end_node_kind = G.nodes[end_node].get("kind", "Unknown kind")
 
-                if i == 0:
-                    single_path.append(f"<drug>{start_node_kind}:{start_node}</drug>")
+        # One extra path tells whether the list was truncated
+        path_list = [
+            format_path(G, path, kinds)
+            for path, kinds in itertools.islice(ranked_paths, max_paths + 1)
+        ]
 
-                single_path.append(
-                    f"<edge>{edge_kind}</edge><drug>{end_node_kind}:{end_node}</drug>"
-                )
-            path_list.append(f"<path>{''.join(single_path)}</path>")
+        if len(path_list) > max_paths or truncated:
+            path_list = path_list[:max_paths]
+            final_path_str = f"Top {len(path_list)} paths from {source_name} to {target_name} with length < {cutoff+1}:\n"
+        else:
+            final_path_str = f"All paths from {source_name} to {target_name} with length < {cutoff+1}:\n"
 
         if len(path_list) == 0:
             return ""
         else:
-            final_path_str += "\n".join(path_list)
+            final_path_str += metapath_counts + "\n".join(path_list)
 
             return final_path_str
     except Exception as e:
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class CSRGraph:
+    """
+    Undirected graph with integer node ids and a NumPy CSR adjacency.
+
+    Node i is named node_names[i] and has kind node_kind_names[node_kinds[i]]. Its neighbours are
+    indices[indptr[i]:indptr[i + 1]], sorted by id, and the edge to each of them has kind
+    edge_kind_names[edge_kinds[...]] at the same position. Kinds are stored as uint8 codes, or as
+    the smallest unsigned integer type that holds them for more than 256 kinds.
+    """
+
+    FORMAT_VERSION = 1
+    ARRAYS = ["indptr", "indices", "edge_kinds", "node_kinds"]
+
+    def __init__(
+        self,
+        node_names,
+        node_kinds,
+        node_kind_names,
+        indptr,
+        indices,
+        edge_kinds,
+        edge_kind_names,
+        metadata=None,
+    ):
+        self.node_names = list(node_names)
+        self.node_kinds = node_kinds
+        self.node_kind_names = list(node_kind_names)
+
+        self.indptr = indptr
+        self.indices = indices
+        self.edge_kinds = edge_kinds
+        self.edge_kind_names = list(edge_kind_names)
+        self.metadata = dict(metadata or {})
+
+        self.name_to_id = {
+            name: node_id for node_id, name in enumerate(self.node_names)
+        }
+
+    @staticmethod
+    def kind_dtype(n_kinds):
+        """
+        Return the smallest unsigned integer type holding the codes of n_kinds kinds.
+        """
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            if n_kinds <= np.iinfo(dtype).max + 1:
+                return dtype
+        raise ValueError(f"Too many kinds to encode: {n_kinds}.")
+
+    @classmethod
+    def from_edges(cls, node_names, node_kinds, sources, targets, edge_kinds):
+        """
+        Build the graph from node names and kinds, and from the endpoint ids and kind of every edge.
+
+        Like networkx.Graph, a repeated node pair keeps a single edge with the kind added last.
+        """
+        node_kind_names, node_kind_codes = np.unique(
+            np.asarray(node_kinds, dtype=object).astype(str), return_inverse=True
+        )
+        edge_kind_names, edge_kind_codes = np.unique(
+            np.asarray(edge_kinds, dtype=object).astype(str), return_inverse=True
+        )
+
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+
+        # Both directions of every edge, self-loops once
+        not_loop = sources != targets
+        rows = np.concatenate([sources, targets[not_loop]])
+        cols = np.concatenate([targets, sources[not_loop]])
+        kinds = np.concatenate([edge_kind_codes, edge_kind_codes[not_loop]])
+        order = np.arange(len(rows))
+
+        # Keep the last occurrence of every (row, col) pair
+        sort = np.lexsort((-order, cols, rows))
+        rows, cols, kinds = rows[sort], cols[sort], kinds[sort]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, kinds = rows[first], cols[first], kinds[first]
+
+        indptr = np.zeros(len(node_names) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(node_names)), out=indptr[1:])
+
+        return cls(
+            node_names,
+            node_kind_codes.astype(cls.kind_dtype(len(node_kind_names))),
+            node_kind_names,
+            indptr,
+            cols.astype(np.int32),
+            kinds.astype(cls.kind_dtype(len(edge_kind_names))),
+            edge_kind_names,
+        )
+
+    @classmethod
+    def from_networkx(cls, G):
+        node_names = list(G.nodes)
+        name_to_id = {name: node_id for node_id, name in enumerate(node_names)}
+
+        edges = list(G.edges(data="kind", default="Unknown relation"))
+
+        return cls.from_edges(
+            node_names,
+            [kind for _, kind in G.nodes(data="kind", default="Unknown kind")],
+            [name_to_id[source] for source, _, _ in edges],
+            [name_to_id[target] for _, target, _ in edges],
+            [kind for _, _, kind in edges],
+        )
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+
+        # Replacing the files keeps the arrays of a loaded graph mapped to the old ones
+        for name in self.ARRAYS:
+            path = os.path.join(directory, f"{name}.npy")
+            with open(f"{path}.tmp", "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(f"{path}.tmp", path)
+
+        # The metadata is written last, a directory without it is incomplete
+        with open(os.path.join(directory, "meta.json.tmp"), "w") as f:
+            json.dump(
+                {
+                    "format_version": self.FORMAT_VERSION,
+                    "node_names": self.node_names,
+                    "node_kind_names": self.node_kind_names,
+                    "edge_kind_names": self.edge_kind_names,
+                    "metadata": self.metadata,
+                },
+                f,
+            )
+        os.replace(
+            os.path.join(directory, "meta.json.tmp"),
+            os.path.join(directory, "meta.json"),
+        )
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, "meta.json"))
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """
+        Load a saved graph, its arrays memory-mapped so worker processes share their pages.
+        """
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+
+        if meta["format_version"] != cls.FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported graph format version {meta['format_version']} in {directory}."
+            )
+
+        arrays = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode)
+            for name in cls.ARRAYS
+        }
+
+        return cls(
+            meta["node_names"],
+            arrays["node_kinds"],
+            meta["node_kind_names"],
+            arrays["indptr"],
+            arrays["indices"],
+            arrays["edge_kinds"],
+            meta["edge_kind_names"],
+            meta.get("metadata"),
+        )
+
+    def fingerprint(self):
+        """
+        SHA-256 of the node names, kinds and adjacency, identifying the node ids of this graph.
+        """
+        digest = hashlib.sha256(
+            json.dumps(
+                [self.node_names, self.node_kind_names, self.edge_kind_names]
+            ).encode("utf-8")
+        )
+        for name in self.ARRAYS:
+            digest.update(np.ascontiguousarray(getattr(self, name)).data)
+        return digest.hexdigest()
+
+    def __len__(self):
+        return len(self.node_names)
+
+    def __contains__(self, name):
+        return name in self.name_to_id
+
+    @property
+    def nodes(self):
+        return self.node_names
+
+    def number_of_edges(self):
+        rows = np.repeat(np.arange(len(self)), np.diff(self.indptr))
+        loops = int(np.count_nonzero(self.indices == rows))
+        return (len(self.indices) + loops) // 2
+
+    def neighbors(self, node_id):
+        return self.indices[self.indptr[node_id] : self.indptr[node_id + 1]]
+
+    def neighbor_edge_kinds(self, node_id):
+        return self.edge_kinds[self.indptr[node_id] : self.indptr[node_id + 1]]
+
+    def degree(self, node_id):
+        return int(self.indptr[node_id + 1] - self.indptr[node_id])
+
+    def node_kind(self, node_id):
+        return self.node_kind_names[self.node_kinds[node_id]]
+
+    def edge_kind_code(self, source_id, target_id):
+        """
+        Return the kind code of the edge between two node ids, None if they are not adjacent.
+        """
+        start, end = self.indptr[source_id], self.indptr[source_id + 1]
+        pos = start + np.searchsorted(self.indices[start:end], target_id)
+
+        if pos < end and self.indices[pos] == target_id:
+            return int(self.edge_kinds[pos])
+        return None
+
+    def edge_kind(self, source_id, target_id):
+        code = self.edge_kind_code(source_id, target_id)
+        return None if code is None else self.edge_kind_names[code]
+
+    def simple_paths(self, source_id, target_id, cutoff):
+        """
+        Yield every simple path of at most cutoff edges from source_id to target_id as a list of ids.
+        """
+        if source_id == target_id:
+            return
+
+        path = [source_id]
+        on_path = {source_id}
+        stack = [iter(self.neighbors(source_id).tolist())]
+
+        while stack:
+            child = next(stack[-1], None)
+
+            if child is None:
+                stack.pop()
+                on_path.discard(path.pop())
+            elif child in on_path:
+                continue
+            elif child == target_id:
+                yield path + [child]
+            elif len(path) < cutoff:
+                path.append(child)
+                on_path.add(child)
+                stack.append(iter(self.neighbors(child).tolist()))
@@ -0,0 +1,284 @@
+import json
+import os
+import sys
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+cwd_path = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(f"{cwd_path}/../../../")
+
+# Hetionet abbreviations, used to name metapaths like CtDrD
+NODE_KIND_ABBREVIATIONS = {
+    "anatomy": "A",
+    "compound": "C",
+    "disease": "D",
+    "pharmacologic class": "PC",
+    "side effect": "SE",
+    "symptom": "S",
+}
+EDGE_KIND_ABBREVIATIONS = {
+    "causes": "c",
+    "includes": "i",
+    "localizes": "l",
+    "palliates": "p",
+    "presents": "p",
+    "resembles": "r",
+    "treats": "t",
+}
+
+
+def graph_schema(G):
+    """
+    Return the (node kind, edge kind, node kind) steps taken by the edges of G, in both directions.
+    """
+    rows = np.repeat(np.arange(len(G)), np.diff(G.indptr))
+    steps = np.unique(
+        np.stack(
+            [
+                G.node_kinds[rows],
+                G.edge_kinds,
+                G.node_kinds[np.asarray(G.indices, dtype=np.int64)],
+            ],
+            axis=1,
+        ),
+        axis=0,
+    )
+
+    return [
+        (G.node_kind_names[source], G.edge_kind_names[edge], G.node_kind_names[target])
+        for source, edge, target in steps.tolist()
+    ]
+
+
+def metapath_name(node_kinds, edge_kinds):
+    name = [NODE_KIND_ABBREVIATIONS.get(node_kinds[0], node_kinds[0])]
+    for edge_kind, node_kind in zip(edge_kinds, node_kinds[1:]):
+        name.append(EDGE_KIND_ABBREVIATIONS.get(edge_kind, edge_kind))
+        name.append(NODE_KIND_ABBREVIATIONS.get(node_kind, node_kind))
+    return "".join(name)
+
+
+def compound_disease_metapaths(G, max_length=3):
+    """
+    Return {name: (node kinds, edge kinds)} of every compound -> disease metapath of G of at most
+    max_length edges, shortest first.
+
+    The metapaths are enumerated from the schema of G, so their instances are exactly the simple
+    compound -> disease paths of at most max_length edges.
+    """
+    steps = graph_schema(G)
+    metapaths = OrderedDict()
+
+    frontier = [(["compound"], [])]
+    for _ in range(max_length):
+        next_frontier = []
+        for node_kinds, edge_kinds in frontier:
+            for source_kind, edge_kind, target_kind in steps:
+                if source_kind != node_kinds[-1]:
+                    continue
+
+                metapath = (node_kinds + [target_kind], edge_kinds + [edge_kind])
+                next_frontier.append(metapath)
+                if target_kind == "disease":
+                    name = metapath_name(*metapath)
+                    # Abbreviations are ambiguous for kinds outside the tables above
+                    if name in metapaths:
+                        name = "-".join(metapath[0])
+                    metapaths[name] = metapath
+        frontier = next_frontier
+
+    return metapaths
+
+
+def _expand(G, paths, edge_kind, node_kind):
+    """
+    Extend every path by one edge of edge_kind to a node of node_kind that is not on the path yet.
+    """
+    last = paths[:, -1].astype(np.int64)
+    starts = G.indptr[last]
+    counts = G.indptr[last + 1] - starts
+
+    rows = np.repeat(np.arange(len(paths)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = np.repeat(starts, counts) + offsets
+
+    neighbors = G.indices[positions].astype(np.int64)
+    keep = (G.edge_kinds[positions] == edge_kind) & (
+        G.node_kinds[neighbors] == node_kind
+    )
+    for column in range(paths.shape[1]):
+        keep &= neighbors != paths[rows, column]
+
+    return np.column_stack([paths[rows[keep]], neighbors[keep]])
+
+
+def metapath_instances(G, source_id, metapath):
+    """
+    Return the (n_instances, len(node kinds)) node ids of the instances of a (node kinds, edge kinds)
+    metapath from source_id.
+    """
+    node_kinds, edge_kinds = metapath
+
+    if G.node_kind(source_id) != node_kinds[0]:
+        return np.empty((0, len(node_kinds)), dtype=np.int64)
+    if any(kind not in G.node_kind_names for kind in node_kinds) or any(
+        kind not in G.edge_kind_names for kind in edge_kinds
+    ):
+        return np.empty((0, len(node_kinds)), dtype=np.int64)
+
+    paths = np.array([[source_id]], dtype=np.int64)
+    for edge_kind, node_kind in zip(edge_kinds, node_kinds[1:]):
+        paths = _expand(
+            G,
+            paths,
+            G.edge_kind_names.index(edge_kind),
+            G.node_kind_names.index(node_kind),
+        )
+
+    return paths
+
+
+def source_metapaths(G, source_id, metapaths, top_n=5):
+    """
+    Return {target id: {metapath: {"count", "paths"}}} for the metapaths starting at source_id.
+
+    The top_n instances kept per metapath are the ones through the least connected intermediate
+    nodes, which are the most specific to the pair.
+    """
+    degrees = np.diff(G.indptr)
+    targets = {}
+
+    for name, metapath in metapaths.items():
+        paths = metapath_instances(G, source_id, metapath)
+        if len(paths) == 0:
+            continue
+
+        specificity = degrees[paths[:, 1:-1]].sum(axis=1)
+        paths = paths[np.lexsort((specificity, paths[:, -1]))]
+        target_ids, starts, counts = np.unique(
+            paths[:, -1], return_index=True, return_counts=True
+        )
+
+        for target_id, start, count in zip(
+            target_ids.tolist(), starts.tolist(), counts.tolist()
+        ):
+            targets.setdefault(target_id, {})[name] = {
+                "count": count,
+                "paths": paths[start : start + min(count, top_n)].tolist(),
+            }
+
+    return targets
+
+
+def shard_of(source_name, num_shards):
+    return zlib.crc32(source_name.encode("utf-8")) % num_shards
+
+
+def build_metapath_index(G, directory, top_n=5, num_shards=16, max_length=3):
+    """
+    Precompute the counts and top instances of every compound -> disease metapath of at most
+    max_length edges, for every compound of G.
+
+    Entries are grouped by compound into num_shards JSON shards, keyed by compound and disease name.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    metapaths = compound_disease_metapaths(G, max_length)
+    shards = [{} for _ in range(num_shards)]
+    compound_kind = G.node_kind_names.index("compound")
+
+    for source_id in tqdm(np.flatnonzero(G.node_kinds == compound_kind).tolist()):
+        targets = source_metapaths(G, source_id, metapaths, top_n)
+        if len(targets) == 0:
+            continue
+
+        source_name = G.node_names[source_id]
+        shards[shard_of(source_name, num_shards)][source_name] = {
+            G.node_names[target_id]: metapaths
+            for target_id, metapaths in targets.items()
+        }
+
+    for shard_id, shard in enumerate(shards):
+        with open(os.path.join(directory, f"shard_{shard_id:03d}.json"), "w") as f:
+            json.dump(shard, f)
+
+    # The manifest is written last, a directory without it is incomplete
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump(
+            {
+                "format_version": MetapathIndex.FORMAT_VERSION,
+                "num_shards": num_shards,
+                "top_n": top_n,
+                "max_length": max_length,
+                "metapaths": metapaths,
+                "nodes": len(G),
+                "graph_fingerprint": G.fingerprint(),
+            },
+            f,
+            indent=2,
+        )
+
+
+class MetapathIndex:
+    """
+    Read side of build_metapath_index, loading each shard on its first lookup.
+
+    Paths are stored as node ids of the graph the index was built from.
+    """
+
+    FORMAT_VERSION = 2
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "manifest.json"), "r") as f:
+            self.manifest = json.load(f)
+
+        self.directory = directory
+        self.shards = {}
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, "manifest.json"))
+
+    @property
+    def format_version(self):
+        # Indexes of a fixed metapath list have no version
+        return self.manifest.get("format_version", 1)
+
+    @property
+    def max_length(self):
+        return self.manifest["max_length"]
+
+    @property
+    def metapaths(self):
+        """
+        {name: (node kinds, edge kinds)} of the indexed metapaths, shortest first.
+        """
+        return OrderedDict(
+            (name, tuple(metapath))
+            for name, metapath in self.manifest["metapaths"].items()
+        )
+
+    def _shard(self, shard_id):
+        if shard_id not in self.shards:
+            with open(
+                os.path.join(self.directory, f"shard_{shard_id:03d}.json"), "r"
+            ) as f:
+                self.shards[shard_id] = json.load(f)
+        return self.shards[shard_id]
+
+    def lookup(self, source_name, target_name):
+        """
+        Return {metapath: {"count", "paths"}} of a compound and disease, None if they are not linked.
+        """
+        shard = self._shard(shard_of(source_name, self.manifest["num_shards"]))
+        return shard.get(source_name, {}).get(target_name)
+
+
+if __name__ == "__main__":
+    from agents.tools.hetionet import hetionet
+
+    G, _ = hetionet()
+    build_metapath_index(G, f"{cwd_path}/data/metapath_index")
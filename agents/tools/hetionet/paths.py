@@ -0,0 +1,147 @@
+import numpy as np
+
+# Edge kinds most telling of a drug's effect on a disease come first
+EDGE_KIND_PRIORITY = [
+    "treats",
+    "palliates",
+    "includes",
+    "resembles",
+    "presents",
+    "localizes",
+    "causes",
+]
+
+
+def edge_kind_ranks(G):
+    """
+    Return the rank of every edge kind code of G, kinds missing from EDGE_KIND_PRIORITY come last.
+    """
+    return np.array(
+        [
+            (
+                EDGE_KIND_PRIORITY.index(kind)
+                if kind in EDGE_KIND_PRIORITY
+                else len(EDGE_KIND_PRIORITY)
+            )
+            for kind in G.edge_kind_names
+        ],
+        dtype=np.int64,
+    )
+
+
+def _common_neighbors(G, u, v):
+    """
+    Return the common neighbours of u and v with the kinds of their edges to u and to v.
+    """
+    common, u_pos, v_pos = np.intersect1d(
+        G.neighbors(u), G.neighbors(v), assume_unique=True, return_indices=True
+    )
+    return common, G.neighbor_edge_kinds(u)[u_pos], G.neighbor_edge_kinds(v)[v_pos]
+
+
+def _paths_of_length_2(G, source_id, target_id):
+    middle, source_kinds, target_kinds = _common_neighbors(G, source_id, target_id)
+
+    keep = (middle != source_id) & (middle != target_id)
+    nodes = np.stack(
+        [
+            np.full(keep.sum(), source_id),
+            middle[keep],
+            np.full(keep.sum(), target_id),
+        ],
+        axis=1,
+    )
+
+    return nodes, np.stack([source_kinds[keep], target_kinds[keep]], axis=1)
+
+
+def _expansion_cost(G, node_id):
+    # Total degree of the neighbours of node_id
+    neighbors = G.neighbors(node_id).astype(np.int64)
+    return int((G.indptr[neighbors + 1] - G.indptr[neighbors]).sum())
+
+
+def _paths_of_length_3(G, source_id, target_id):
+    """
+    Meet in the middle: join every neighbour of the cheaper endpoint with the neighbours of the other.
+    """
+    reverse = _expansion_cost(G, target_id) < _expansion_cost(G, source_id)
+    if reverse:
+        source_id, target_id = target_id, source_id
+
+    nodes, kinds = [], []
+    for first, first_kind in zip(
+        G.neighbors(source_id).tolist(), G.neighbor_edge_kinds(source_id).tolist()
+    ):
+        if first in (source_id, target_id):
+            continue
+
+        second, middle_kinds, target_kinds = _common_neighbors(G, first, target_id)
+        keep = (second != source_id) & (second != target_id) & (second != first)
+        if not keep.any():
+            continue
+
+        count = keep.sum()
+        nodes.append(
+            np.stack(
+                [
+                    np.full(count, source_id),
+                    np.full(count, first),
+                    second[keep],
+                    np.full(count, target_id),
+                ],
+                axis=1,
+            )
+        )
+        kinds.append(
+            np.stack(
+                [np.full(count, first_kind), middle_kinds[keep], target_kinds[keep]],
+                axis=1,
+            )
+        )
+
+    if len(nodes) == 0:
+        kinds = np.empty((0, 3), dtype=G.edge_kinds.dtype)
+        return np.empty((0, 4), dtype=np.int64), kinds
+
+    nodes, kinds = np.concatenate(nodes), np.concatenate(kinds)
+    if reverse:
+        nodes, kinds = nodes[:, ::-1], kinds[:, ::-1]
+
+    return nodes, kinds
+
+
+def iter_ranked_paths(G, source_id, target_id, cutoff=2):
+    """
+    Lazily yield the simple paths of at most cutoff edges between two nodes of a CSRGraph.
+
+    Every path is a (node ids, edge kind codes) pair. Shorter paths come first, paths of the same
+    length are ordered by the EDGE_KIND_PRIORITY ranks of their edges. Paths of up to 3 edges are
+    enumerated by joining neighbour sets, longer cutoffs fall back to an unranked depth-first search.
+    """
+    if source_id == target_id:
+        return
+
+    if cutoff > 3:
+        for path in G.simple_paths(source_id, target_id, cutoff):
+            yield path, [G.edge_kind_code(u, v) for u, v in zip(path[:-1], path[1:])]
+        return
+
+    kind_ranks = edge_kind_ranks(G)
+
+    if cutoff >= 1:
+        kind = G.edge_kind_code(source_id, target_id)
+        if kind is not None:
+            yield [source_id, target_id], [kind]
+
+    for length, enumerate_paths in [(2, _paths_of_length_2), (3, _paths_of_length_3)]:
+        if cutoff < length:
+            break
+
+        nodes, kinds = enumerate_paths(G, source_id, target_id)
+        order = np.lexsort(
+            (*nodes.T[::-1], kind_ranks[kinds.astype(np.int64)].sum(axis=1))
+        )
+
+        for idx in order:
+            yield nodes[idx].tolist(), kinds[idx].tolist()
@@ -1,31 +1,30 @@
-import json
 import os
 import sys
 
 import pandas as pd
 
-from core.utils import match_name
-
 cwd_path = os.path.dirname(os.path.realpath(__file__))
-sys.path.append(f"{cwd_path}/../../")
+sys.path.append(f"{cwd_path}/../../../")
 
+from agents.tools.risk_model.aggregate_store import (
+    OutcomeAggregateStore,
+    wilson_interval,
+)
+from agents.tools.trial_data import load_trials
+from core.resources import lazy_resource
+from core.utils import AliasIndex, name_synonyms
 
-if os.path.exists(f"{cwd_path}/data/drug_success_ratio.json") and os.path.exists(
-    f"{cwd_path}/data/disease_success_ratio.json"
-):
-    drug_success_ratio = json.load(
-        open(f"{cwd_path}/data/drug_success_ratio.json", "r")
-    )
-    disease_success_ratio = json.load(
-        open(f"{cwd_path}/data/disease_success_ratio.json", "r")
-    )
-else:
+
+def load_trial_success():
+    """
+    Return the (nctid, criteria, drugs, diseases, label) trials with a success label in IQVIA.
+    """
     # NCT ID to label
     trial_outcome_df = pd.read_csv(
         f"{cwd_path}/../enrollment/data/IQVIA/IQVIA_trial_outcomes.csv"
     )
     outcome2label = (
-        pd.read_csv(f"data/outcome2label.txt", sep="\t", header=None)
+        pd.read_csv(f"{cwd_path}/data/outcome2label.txt", sep="\t", header=None)
         .set_index(0)[1]
         .to_dict()
     )
@@ -35,55 +34,126 @@ else:
     ]
 
     # Merge with trial data
-    trial_df = pd.read_csv(
-        f"{cwd_path}/../enrollment/data/trial_data.csv", sep="\t"
-    ).drop("label", axis=1)
+    if os.path.exists(f"{cwd_path}/../enrollment/data/trial_data.parquet"):
+        trial_df = load_trials(f"{cwd_path}/../enrollment/data/trial_data.parquet")
+    else:
+        trial_df = load_trials(f"{cwd_path}/../enrollment/data/trial_data.csv")
+    trial_df = trial_df.drop("label", axis=1)
+
     trial_success_df = pd.merge(
         trial_df, nctid2label_df, left_on="nctid", right_on="studyid", how="inner"
     ).drop("studyid", axis=1)
-    trial_success_df.to_csv(f"{cwd_path}/data/trial_success.csv", sep="\t", index=False)
 
-    drug_df = trial_success_df[["drugs", "label"]]
-    drug_df["drugs"] = drug_df["drugs"].str.strip().str.lower()
-    drug_df["drugs"] = drug_df["drugs"].str.split(";")
-    drug_df_expanded = drug_df.explode("drugs").reset_index(drop=True)
-    drug_df_expanded["drugs"] = drug_df_expanded["drugs"].str.strip()
+    return trial_success_df
 
-    # Calculate the label ratio for every drug
-    drug_label_ratio = drug_df_expanded.groupby("drugs")["label"].mean()
-    drug_success_ratio = drug_label_ratio.to_dict()
 
-    json.dump(drug_success_ratio, open(f"{cwd_path}/data/drug_success_ratio.json", "w"))
+def build_success_counts(store):
+    """
+    Fold the labelled trials into store, from trial_success.csv if an earlier build left it.
+    """
+    if os.path.exists(f"{cwd_path}/data/trial_success.csv"):
+        trial_success_df = pd.read_csv(f"{cwd_path}/data/trial_success.csv", sep="\t")
+    else:
+        trial_success_df = load_trial_success()
+        trial_success_df.to_csv(
+            f"{cwd_path}/data/trial_success.csv", sep="\t", index=False
+        )
 
-    disease_df = trial_success_df[["diseases", "label"]]
-    disease_df["diseases"] = disease_df["diseases"].str.strip().str.lower()
-    disease_df["diseases"] = disease_df["diseases"].str.split(";")
-    disease_df_expanded = disease_df.explode("diseases").reset_index(drop=True)
-    disease_df_expanded["diseases"] = disease_df_expanded["diseases"].str.strip()
+    store.fold(trial_success_df)
 
-    # Calculate the label ratio for every disease
-    disease_label_ratio = disease_df_expanded.groupby("diseases")["label"].mean()
-    disease_success_ratio = disease_label_ratio.to_dict()
+    return store
 
-    json.dump(
-        disease_success_ratio, open(f"{cwd_path}/data/disease_success_ratio.json", "w")
-    )
 
+@lazy_resource("risk_model")
+def success_counts():
+    store_path = f"{cwd_path}/data/success_counts"
 
-def get_disease_risk(disease_name):
-    disease_name = disease_name.strip().lower()
-
-    if disease_name in disease_success_ratio:
-        return round(1 - disease_success_ratio[disease_name], 4)
+    if OutcomeAggregateStore.exists(store_path):
+        store = OutcomeAggregateStore(store_path)
     else:
+        store = build_success_counts(OutcomeAggregateStore(store_path))
+
+    drug_index = AliasIndex(store.entities("drug"), synonyms=name_synonyms())
+    # Unlike drugs, a disease is not matched to whichever disease is closest
+    disease_index = AliasIndex(store.entities("disease"), max_ratio=0.2)
+
+    return store, drug_index, disease_index
+
+
+def fold_trial_outcomes(trial_success_df):
+    """
+    Add new labelled trials (nctid, drugs, diseases, label) to the success counts.
+    """
+    store, _, _ = success_counts()
+    folded = store.fold(trial_success_df)
+
+    # The name indexes are rebuilt with the new entities
+    success_counts.reset()
+
+    return folded
+
+
+def risk_stats(kind, name):
+    """
+    Return the historical failure rate of an entity with its 95% Wilson interval and trial count.
+    """
+    store, _, _ = success_counts()
+
+    counts = store.get(kind, name)
+    if counts is None:
         return None
 
+    successes, total = counts
+    success_low, success_high = wilson_interval(successes, total)
 
-def get_drug_risk(drug_name):
-    drug_name = drug_name.strip().lower()
-    drug_name = match_name(drug_name, drug_success_ratio.keys())
+    return {
+        "risk": round(1 - successes / total, 4),
+        "low": round(1 - success_high, 4),
+        "high": round(1 - success_low, 4),
+        "trials": total,
+    }
 
-    if drug_name in drug_success_ratio:
-        return round(1 - drug_success_ratio[drug_name], 4)
-    else:
+
+def get_disease_risk_stats(disease_name):
+    _, _, disease_index = success_counts()
+
+    disease_name = disease_index.resolve(disease_name)
+    if disease_name is None:
         return None
+
+    return risk_stats("disease", disease_name)
+
+
+def get_drug_risk_stats(drug_name):
+    _, drug_index, _ = success_counts()
+
+    drug_name = drug_index.resolve(drug_name)
+    if drug_name is None:
+        return None
+
+    return risk_stats("drug", drug_name)
+
+
+def name_resolution_stats():
+    """
+    Return how drug and disease queries were resolved so far, with their hit and fuzzy rates.
+    """
+    _, drug_index, disease_index = success_counts()
+
+    return {"drug": drug_index.stats(), "disease": disease_index.stats()}
+
+
+def get_disease_risk(disease_name):
+    stats = get_disease_risk_stats(disease_name)
+
+    return None if stats is None else stats["risk"]
+
+
+def get_drug_risk(drug_name):
+    stats = get_drug_risk_stats(drug_name)
+
+    return None if stats is None else stats["risk"]
+
+
+if __name__ == "__main__":
+    success_counts()
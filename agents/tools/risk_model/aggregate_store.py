@@ -0,0 +1,181 @@
+import json
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def wilson_interval(successes, total, z=1.96):
+    """
+    Wilson score interval of a success rate, (0.0, 1.0) when there is no trial.
+    """
+    if total == 0:
+        return 0.0, 1.0
+
+    rate = successes / total
+    denominator = 1 + z**2 / total
+    center = (rate + z**2 / (2 * total)) / denominator
+    margin = z * math.sqrt(rate * (1 - rate) / total + z**2 / (4 * total**2))
+    margin /= denominator
+
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+def explode_entities(trial_df, column):
+    """
+    One (entity, nctid, label) row per entity of the semicolon-separated column of trial_df.
+    """
+    entity_df = trial_df[["nctid", column, "label"]].copy()
+    entity_df[column] = entity_df[column].str.strip().str.lower().str.split(";")
+    entity_df = entity_df.explode(column).reset_index(drop=True)
+    entity_df[column] = entity_df[column].str.strip()
+
+    return entity_df.rename(columns={column: "entity"})
+
+
+class OutcomeAggregateStore:
+    """
+    Per-entity (success count, total count) of trial outcomes, for drugs and diseases.
+
+    Each kind is a name list plus an (n, 2) int64 count matrix saved as .npy and memory-mapped for
+    reads. Outcomes are folded in incrementally, trials already folded are skipped. Every fold
+    writes new files and bumps the version in manifest.json, which is written last.
+    """
+
+    KINDS = {"drug": "drugs", "disease": "diseases"}
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self._load()
+
+    @classmethod
+    def exists(cls, directory):
+        return os.path.exists(os.path.join(directory, "manifest.json"))
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {"version": 0, "files": {}}
+
+        self.names, self.rows, self.counts = {}, {}, {}
+        for kind in self.KINDS:
+            files = self.manifest["files"].get(kind)
+
+            if files is None:
+                names, counts = [], np.zeros((0, 2), dtype=np.int64)
+            else:
+                with open(self._path(files["names"]), "r") as f:
+                    names = json.load(f)
+                counts = np.load(self._path(files["counts"]), mmap_mode="r")
+
+            self.names[kind] = names
+            self.rows[kind] = {name: row for row, name in enumerate(names)}
+            self.counts[kind] = counts
+
+        nctids_file = self.manifest["files"].get("nctids")
+        if nctids_file is None:
+            self.nctids = set()
+        else:
+            with open(self._path(nctids_file), "r") as f:
+                self.nctids = set(json.load(f))
+
+    @property
+    def version(self):
+        return self.manifest["version"]
+
+    def fold(self, trial_df):
+        """
+        Add the outcomes of the trials of trial_df (nctid, drugs, diseases, label) not folded yet.
+
+        Returns the number of trials folded in.
+        """
+        trial_df = trial_df[~trial_df["nctid"].isin(self.nctids)]
+        trial_df = trial_df.drop_duplicates("nctid")
+        if len(trial_df) == 0:
+            return 0
+
+        version = self.version + 1
+        files = {}
+
+        for kind, column in self.KINDS.items():
+            entity_df = explode_entities(trial_df, column)
+            entity_counts = entity_df.groupby("entity")["label"].agg(["sum", "count"])
+
+            names = list(self.names[kind])
+            rows = dict(self.rows[kind])
+            new_names = [name for name in entity_counts.index if name not in rows]
+            for name in new_names:
+                rows[name] = len(names)
+                names.append(name)
+
+            counts = np.zeros((len(names), 2), dtype=np.int64)
+            counts[: len(self.counts[kind])] = self.counts[kind]
+            counts[[rows[name] for name in entity_counts.index]] += entity_counts[
+                ["sum", "count"]
+            ].to_numpy(dtype=np.int64)
+
+            files[kind] = {
+                "names": f"{kind}_names.v{version}.json",
+                "counts": f"{kind}_counts.v{version}.npy",
+            }
+            with open(self._path(files[kind]["names"]), "w") as f:
+                json.dump(names, f)
+            np.save(self._path(files[kind]["counts"]), counts)
+
+        files["nctids"] = f"nctids.v{version}.json"
+        with open(self._path(files["nctids"]), "w") as f:
+            json.dump(sorted(self.nctids | set(trial_df["nctid"])), f)
+
+        previous_files = self.manifest["files"]
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump({"version": version, "files": files}, f, indent=2)
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+        self._load()
+        self._remove_files(previous_files)
+
+        return len(trial_df)
+
+    def _remove_files(self, files):
+        for entry in files.values():
+            for name in entry.values() if isinstance(entry, dict) else [entry]:
+                if os.path.exists(self._path(name)):
+                    os.remove(self._path(name))
+
+    def entities(self, kind):
+        return self.names[kind]
+
+    def get(self, kind, name):
+        """
+        Return the (success count, total count) of an entity, None if it has no trial.
+        """
+        row = self.rows[kind].get(name)
+        if row is None:
+            return None
+
+        successes, total = self.counts[kind][row]
+        return int(successes), int(total)
+
+    def success_rate(self, kind, name):
+        counts = self.get(kind, name)
+        if counts is None:
+            return None
+
+        successes, total = counts
+        return successes / total
+
+    def to_frame(self, kind):
+        return pd.DataFrame(
+            np.asarray(self.counts[kind]),
+            index=self.names[kind],
+            columns=["success", "total"],
+        )
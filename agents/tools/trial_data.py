@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree as ET
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm import tqdm
+
+TRIAL_COLUMNS = ["nctid", "criteria", "drugs", "diseases", "label"]
+
+
+def trial_nctid(trial_path):
+    return trial_path.split("/")[-1].split(".")[0]
+
+
+def parse_trial_xml(xml_path):
+    """
+    Stream a ClinicalTrials.gov study file and return its (criteria, drugs, diseases).
+
+    Only the top-level <condition>, <intervention> and <eligibility> elements are kept, every other
+    element is cleared as soon as it is parsed. Returns None if one of the fields is missing.
+    """
+    criteria, drug_interventions, conditions = None, [], []
+
+    try:
+        depth, root = 0, None
+        for event, elem in ET.iterparse(xml_path, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if elem.tag == "condition":
+                conditions.append(elem.text.lower().strip())
+            elif elem.tag == "intervention":
+                if elem.find("intervention_type").text == "Drug":
+                    drug_interventions.append(
+                        elem.find("intervention_name").text.lower().strip()
+                    )
+            elif elem.tag == "eligibility":
+                criteria = elem.find("criteria").find("textblock").text
+                # The schema orders <condition> and <intervention> before <eligibility>
+                break
+
+            root.clear()
+
+    except AttributeError:
+        print(f"Don't have criteria or drug or diseases for {xml_path}")
+        return None
+
+    if not criteria or len(drug_interventions) == 0 or len(conditions) == 0:
+        return None
+
+    return criteria, ";".join(drug_interventions), ";".join(conditions)
+
+
+def _parse_trial(args):
+    nctid, xml_path = args
+    return nctid, parse_trial_xml(xml_path)
+
+
+def ingest_trials(
+    trial_paths,
+    output_path,
+    nctid_set=None,
+    positive_set=frozenset(),
+    max_workers=None,
+    chunksize=64,
+    row_group_size=10_000,
+):
+    """
+    Parse the study files across a process pool into a Parquet table indexed by nctid.
+
+    Rows keep the order of `trial_paths` and are written one row group at a time, so memory stays
+    bounded by `row_group_size`. Only nctids in `nctid_set` are parsed, nctids in `positive_set`
+    get label 1.
+    """
+    jobs = []
+    for trial_path in trial_paths:
+        nctid = trial_nctid(trial_path)
+        if nctid_set is None or nctid in nctid_set:
+            jobs.append((nctid, trial_path))
+
+    tmp_path = f"{output_path}.tmp"
+    writer = None
+    rows = []
+    n_rows = 0
+
+    def flush():
+        nonlocal writer
+        trial_df = pd.DataFrame(rows, columns=TRIAL_COLUMNS).set_index("nctid")
+        table = pa.Table.from_pandas(trial_df, preserve_index=True)
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_path, table.schema)
+        writer.write_table(table)
+        rows.clear()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        results = pool.map(_parse_trial, jobs, chunksize=chunksize)
+        for nctid, trial in tqdm(results, total=len(jobs)):
+            if trial is None:
+                continue
+
+            rows.append((nctid, *trial, 1 if nctid in positive_set else 0))
+            n_rows += 1
+            if len(rows) >= row_group_size:
+                flush()
+
+    if rows or writer is None:
+        flush()
+    writer.close()
+    os.replace(tmp_path, output_path)
+
+    return n_rows
+
+
+def load_trials(trial_path):
+    """
+    Read an ingested Parquet table, or a legacy tab-separated trial_data.csv, with nctid as a column.
+    """
+    if trial_path.endswith(".csv"):
+        return pd.read_csv(trial_path, sep="\t")
+
+    return pd.read_parquet(trial_path).reset_index()
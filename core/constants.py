@@ -8,3 +8,47 @@ load_dotenv()
 class LLMConstants:
     GPT_MODEL = "gpt-4o"
     OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
+
+    # Attempts per LLM request, shared by the sync and async clients
+    MAX_ATTEMPTS = 5
+
+    # Upper bound on in-flight LLM requests of the process
+    MAX_CONCURRENT_REQUESTS = int(
+        os.environ.get("CLINICAL_AGENT_MAX_CONCURRENT_REQUESTS", 16)
+    )
+
+
+class CacheConstants:
+    ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", ".cache"))
+
+    # Set CLINICAL_AGENT_LLM_CACHE=0 to always call the LLM
+    LLM_CACHE_ENABLED = os.environ.get("CLINICAL_AGENT_LLM_CACHE", "1") != "0"
+    LLM_CACHE_DIR = os.environ.get(
+        "CLINICAL_AGENT_LLM_CACHE_DIR", os.path.join(ROOT_DIR, "llm")
+    )
+    LLM_CACHE_TTL = int(os.environ.get("CLINICAL_AGENT_LLM_CACHE_TTL", 7 * 24 * 3600))
+    LLM_CACHE_SIZE_LIMIT = int(
+        os.environ.get("CLINICAL_AGENT_LLM_CACHE_SIZE_LIMIT", 2**30)
+    )
+
+
+class ExecutionConstants:
+    # Upper bound on subproblems solved at the same time in concurrent mode
+    MAX_WORKERS = int(os.environ.get("CLINICAL_AGENT_MAX_WORKERS", 4))
+
+    # Upper bound on tool calls of a single LLM turn executed at the same time
+    MAX_TOOL_WORKERS = int(os.environ.get("CLINICAL_AGENT_MAX_TOOL_WORKERS", 8))
+
+    # Seconds to wait for a tool call before reporting it as timed out
+    TOOL_TIMEOUT = float(os.environ.get("CLINICAL_AGENT_TOOL_TIMEOUT", 600))
+
+    # Set CLINICAL_AGENT_PLAN_CACHE=0 to decompose every specialist question with the LLM
+    PLAN_CACHE_ENABLED = os.environ.get("CLINICAL_AGENT_PLAN_CACHE", "1") != "0"
+
+
+class InferenceConstants:
+    # Enrollment model backend, "fp32" or "int8" (dynamically quantised, CPU only)
+    ENROLLMENT_BACKEND = os.environ.get("CLINICAL_AGENT_ENROLLMENT_BACKEND", "fp32")
+
+    # Intra-op threads of local model inference, 0 keeps the PyTorch default
+    NUM_THREADS = int(os.environ.get("CLINICAL_AGENT_NUM_THREADS", 0))
@@ -0,0 +1,69 @@
+import hashlib
+import json
+
+import diskcache
+from openai.types.chat import ChatCompletion
+
+
+class LLMCache:
+    """
+    On-disk, content-addressed cache of ChatCompletion responses.
+
+    Entries are keyed on the hash of (model, messages, tools, temperature), expire after `ttl`
+    seconds and are evicted least-recently-used once the cache grows beyond `size_limit` bytes.
+    """
+
+    # Responses that LLMAgent turns into exceptions are not worth replaying
+    UNCACHEABLE_FINISH_REASONS = ("length", "content_filter")
+
+    def __init__(self, directory, ttl=None, size_limit=2**30):
+        self.ttl = ttl
+        self.cache = diskcache.Cache(
+            directory,
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+        )
+        # Hit/miss counters are persisted in the cache database
+        self.cache.stats(enable=True)
+
+    @staticmethod
+    def make_key(model, messages, tools=None, temperature=None):
+        payload = json.dumps(
+            {
+                "model": model,
+                "messages": messages,
+                "tools": tools or [],
+                "temperature": temperature,
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        data = self.cache.get(key)
+        if data is None:
+            return None
+        return ChatCompletion.model_validate(data)
+
+    def set(self, key, response):
+        if any(
+            choice.finish_reason in self.UNCACHEABLE_FINISH_REASONS
+            for choice in response.choices
+        ):
+            return
+        self.cache.set(key, response.model_dump(), expire=self.ttl)
+
+    def stats(self):
+        hits, misses = self.cache.stats()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "entries": len(self.cache),
+            "size_bytes": self.cache.volume(),
+        }
+
+    def clear(self):
+        self.cache.clear()
+        self.cache.stats(reset=True)
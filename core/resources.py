@@ -0,0 +1,137 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+def file_signature(paths):
+    """
+    (path, mtime in ns, size) of every path, None for the paths that do not exist.
+    """
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            signature.append((path, None, None))
+        else:
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+class LazyResource:
+    """
+    A heavy artifact (model, table, graph) materialised by `loader` on first use.
+
+    Calling the resource returns the loaded value. Concurrent first calls are serialised, so the
+    loader runs exactly once unless it raises, in which case the next call retries.
+
+    If `watch` is given, a function returning the files the value is loaded from, a call whose
+    files changed (mtime or size) since the load reloads the value. Callers still holding the
+    previous value keep a consistent copy of it.
+    """
+
+    def __init__(self, name, loader, watch=None):
+        self.name = name
+        self.loader = loader
+        self.watch = watch
+
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._value = None
+        self._signature = None
+
+    def _stale(self):
+        return (
+            self.watch is not None and file_signature(self.watch()) != self._signature
+        )
+
+    def __call__(self):
+        if not self._loaded or self._stale():
+            with self._lock:
+                if not self._loaded or self._stale():
+                    self._value = self.loader()
+                    # Taken after the load, which may create the watched files
+                    if self.watch is not None:
+                        self._signature = file_signature(self.watch())
+                    self._loaded = True
+        return self._value
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def reset(self):
+        """
+        Drop the loaded value, the next call loads it again.
+        """
+        with self._lock:
+            self._loaded = False
+            self._value = None
+
+
+def _loader_origin(loader):
+    """
+    (source file, qualified name) of a loader, the same for a module imported under two names.
+    """
+    code = getattr(loader, "__code__", None)
+    if code is None:
+        return getattr(loader, "__module__", None), repr(loader)
+    return os.path.realpath(code.co_filename), loader.__qualname__
+
+
+class ResourceRegistry:
+    def __init__(self):
+        self.resources = {}
+
+    def register(self, name, loader, watch=None):
+        """
+        Register loader as the resource name and return it.
+
+        A module executed both as a script and as an import registers its resources twice, the
+        second registration of the same loader returns the first resource. Raises ValueError if
+        name is already taken by another loader.
+        """
+        if name in self.resources:
+            source, qualname = _loader_origin(self.resources[name].loader)
+            if (source, qualname) != _loader_origin(loader):
+                raise ValueError(
+                    f"Resource {name} is already registered by {qualname} in {source}."
+                )
+            return self.resources[name]
+
+        self.resources[name] = LazyResource(name, loader, watch)
+        return self.resources[name]
+
+    def get(self, name):
+        return self.resources[name]()
+
+    def warmup(self, names=None, max_workers=None):
+        """
+        Load the given resources (all registered ones by default) concurrently and return their names.
+        """
+        if names is None:
+            names = list(self.resources)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # list() re-raises the first loader error
+            list(pool.map(self.get, names))
+
+        return names
+
+
+RESOURCES = ResourceRegistry()
+
+
+def lazy_resource(name, watch=None):
+    """
+    Decorator registering a loader function as a lazy resource, reloaded when the watched files change.
+    """
+
+    def decorator(loader):
+        return RESOURCES.register(name, loader, watch)
+
+    return decorator
+
+
+def warmup(names=None, max_workers=None):
+    return RESOURCES.warmup(names, max_workers)
@@ -1,29 +1,145 @@
+import asyncio
 import inspect
 import json
 import logging
 import os
 import sys
-
-import Levenshtein
-from openai import OpenAI
+import threading
+import weakref
+from collections import defaultdict, deque
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI
+from rapidfuzz import distance as fuzz_distance
+from rapidfuzz import process
 from tenacity import retry, stop_after_attempt, wait_random_exponential
 
-from core.constants import LLMConstants
+from core.constants import CacheConstants, LLMConstants
+from core.llm_cache import LLMCache
+from core.resources import lazy_resource
+
+# Retries are handled by llm_retry only
+client = OpenAI(api_key=LLMConstants.OPENAI_API_KEY, max_retries=0)
+
+# Single retry policy shared by the sync and async request paths
+llm_retry = retry(
+    wait=wait_random_exponential(multiplier=1, max=40),
+    stop=stop_after_attempt(LLMConstants.MAX_ATTEMPTS),
+    reraise=True,
+)
+
 
-client = OpenAI(api_key=LLMConstants.OPENAI_API_KEY)
+class RequestLimiter:
+    """
+    Counting semaphore shared by threads and event loops.
+
+    acquire blocks the calling thread, aacquire suspends the calling coroutine, and both draw on
+    the same slots. Waiters are served in arrival order whichever kind they are.
+    """
+
+    def __init__(self, limit):
+        self._lock = threading.Lock()
+        self._available = limit
+        self._waiters = deque()
+
+    def _try_acquire(self):
+        # Called with the lock held
+        if self._available > 0 and len(self._waiters) == 0:
+            self._available -= 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            self._waiters.append(event.set)
+        event.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def grant():
+            # A slot handed to a waiter cancelled meanwhile is passed on
+            if future.cancelled():
+                self.release()
+            else:
+                future.set_result(None)
+
+        def wake():
+            loop.call_soon_threadsafe(grant)
+
+        with self._lock:
+            if self._try_acquire():
+                return
+            self._waiters.append(wake)
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                waiting = wake in self._waiters
+                if waiting:
+                    self._waiters.remove(wake)
+            if not waiting and future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if len(self._waiters) == 0:
+                self._available += 1
+                return
+            wake = self._waiters.popleft()
+        # The slot goes straight to the first waiter
+        wake()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    async def __aenter__(self):
+        await self.aacquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+# Bounds the in-flight LLM requests of the process, sync and async calls alike
+LLM_LIMITER = RequestLimiter(LLMConstants.MAX_CONCURRENT_REQUESTS)
+
+# AsyncOpenAI clients are bound to the event loop they were created on
+_async_clients = weakref.WeakKeyDictionary()
+
+if CacheConstants.LLM_CACHE_ENABLED:
+    LLM_CACHE = LLMCache(
+        CacheConstants.LLM_CACHE_DIR,
+        ttl=CacheConstants.LLM_CACHE_TTL,
+        size_limit=CacheConstants.LLM_CACHE_SIZE_LIMIT,
+    )
+else:
+    LLM_CACHE = None
 
 CWD_PATH = os.path.dirname(os.path.realpath(__file__))
 
-NAME_SYNONYMS = json.load(
-    open(
+
+@lazy_resource("name_synonyms")
+def name_synonyms():
+    with open(
         os.path.abspath(
             os.path.join(
                 CWD_PATH, "..", "agents/tools/drugbank/data/name_synonyms.json"
             )
         ),
         "r",
-    )
-)
+    ) as f:
+        return json.load(f)
 
 
 # Custom Logger class
@@ -77,34 +193,99 @@ def setup_custom_logger(name):
 LOGGER = setup_custom_logger("my_logger")
 
 
-@retry(wait=wait_random_exponential(multiplier=1, max=40), stop=stop_after_attempt(5))
-def llm_request(messages, tools=None, model=LLMConstants.GPT_MODEL):
-    try:
-        if tools and len(tools) > 0:
-            response = client.chat.completions.create(
-                model=model, messages=messages, tools=tools
-            )
-        else:
-            response = client.chat.completions.create(model=model, messages=messages)
+def _chat_completion_kwargs(messages, tools, model, temperature):
+    kwargs = {"model": model, "messages": messages}
+    if tools and len(tools) > 0:
+        kwargs["tools"] = tools
+    if temperature is not None:
+        kwargs["temperature"] = temperature
+    return kwargs
+
+
+def _cache_key(messages, tools, model, temperature):
+    if LLM_CACHE is None:
+        return None
+    return LLMCache.make_key(model, messages, tools, temperature)
+
+
+def _log_failed_request(messages, tools, e):
+    LOGGER.log_with_depth("Unable to generate ChatCompletion response")
+    LOGGER.log_with_depth(messages)
+    LOGGER.log_with_depth(tools)
+    LOGGER.log_with_depth(f"Exception: {e}")
+
+
+def llm_request(messages, tools=None, model=LLMConstants.GPT_MODEL, temperature=None):
+    key = _cache_key(messages, tools, model, temperature)
+    if key is not None:
+        response = LLM_CACHE.get(key)
+        if response is not None:
+            return response
 
-        return response
-    except Exception as e:
+    response = _llm_request(messages, tools, model, temperature)
+
+    if key is not None:
+        LLM_CACHE.set(key, response)
+    return response
+
+
+@llm_retry
+def _llm_request(messages, tools, model, temperature):
+    with LLM_LIMITER:
         try:
-            if tools and len(tools) > 0:
-                response = client.chat.completions.create(
-                    model=model, messages=messages, tools=tools
-                )
-            else:
-                response = client.chat.completions.create(
-                    model=model, messages=messages
-                )
+            return client.chat.completions.create(
+                **_chat_completion_kwargs(messages, tools, model, temperature)
+            )
+        except Exception as e:
+            _log_failed_request(messages, tools, e)
+            raise e
 
+
+def get_async_client():
+    """
+    Return the AsyncOpenAI client of the running event loop, sharing one connection pool per loop.
+    """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        _async_clients[loop] = AsyncOpenAI(
+            api_key=LLMConstants.OPENAI_API_KEY,
+            # Retries are handled by llm_retry only
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=LLMConstants.MAX_CONCURRENT_REQUESTS,
+                    max_keepalive_connections=LLMConstants.MAX_CONCURRENT_REQUESTS,
+                )
+            ),
+        )
+    return _async_clients[loop]
+
+
+async def allm_request(
+    messages, tools=None, model=LLMConstants.GPT_MODEL, temperature=None
+):
+    key = _cache_key(messages, tools, model, temperature)
+    if key is not None:
+        response = LLM_CACHE.get(key)
+        if response is not None:
             return response
+
+    response = await _allm_request(messages, tools, model, temperature)
+
+    if key is not None:
+        LLM_CACHE.set(key, response)
+    return response
+
+
+@llm_retry
+async def _allm_request(messages, tools, model, temperature):
+    async with LLM_LIMITER:
+        try:
+            return await get_async_client().chat.completions.create(
+                **_chat_completion_kwargs(messages, tools, model, temperature)
+            )
         except Exception as e:
-            LOGGER.log_with_depth("Unable to generate ChatCompletion response")
-            LOGGER.log_with_depth(messages)
-            LOGGER.log_with_depth(tools)
-            LOGGER.log_with_depth(f"Exception: {e}")
+            _log_failed_request(messages, tools, e)
             raise e
 
 
@@ -137,46 +318,210 @@ def exec_func(response_choice):
     return results
 
 
+def _log_similar_name(target_string, similar_name, distance):
+    LOGGER.log_with_depth(
+        f"Similar Name: {target_string} -> {similar_name}, levenshtein distance: {distance}",
+        depth=2,
+    )
+
+
 def find_least_levenshtein_distance(target_string, array):
+    if isinstance(array, NameMatcher):
+        return array.match(target_string)
+
     array = list(array)
 
     # Ensure the array is not empty
     if not array:
         return None, float("inf")
 
-    # Initialize minimum distance and corresponding string
-    min_distance = float("inf")
-    min_string = None
+    # Vectorised scoring, the first of several equally distant strings wins
+    min_string, min_distance, _ = process.extractOne(
+        target_string, array, scorer=fuzz_distance.Levenshtein.distance
+    )
+
+    _log_similar_name(target_string, min_string, min_distance)
+
+    return min_string, min_distance
+
+
+class NameMatcher:
+    """
+    Fuzzy matcher over a fixed vocabulary of names, built once and queried many times.
+
+    Candidates are scored by Levenshtein distance with RapidFuzz. With `ngram_size` set, only the
+    names sharing at least one character n-gram with the query are scored.
+    """
+
+    def __init__(self, names, ngram_size=None):
+        # Unique names, in their original order
+        self.names = list(dict.fromkeys(names))
+        self.name_set = set(self.names)
+
+        self.ngram_size = ngram_size
+        self.ngram_index = None
+        if ngram_size is not None:
+            self.ngram_index = defaultdict(list)
+            for idx, name in enumerate(self.names):
+                for ngram in self._ngrams(name):
+                    self.ngram_index[ngram].append(idx)
+
+    def __contains__(self, name):
+        return name in self.name_set
+
+    def __len__(self):
+        return len(self.names)
+
+    def _ngrams(self, text):
+        padded = f" {text} "
+        return {
+            padded[i : i + self.ngram_size]
+            for i in range(max(len(padded) - self.ngram_size + 1, 1))
+        }
+
+    def _candidates(self, name):
+        if self.ngram_index is None:
+            return self.names
+
+        ids = set()
+        for ngram in self._ngrams(name):
+            ids.update(self.ngram_index.get(ngram, ()))
+
+        # Nothing shares an n-gram with the query, score the whole vocabulary
+        if len(ids) == 0:
+            return self.names
+
+        return [self.names[idx] for idx in sorted(ids)]
+
+    def match(self, name):
+        """
+        Return the closest name and its Levenshtein distance, or (None, inf) for an empty vocabulary.
+        """
+        if name in self.name_set:
+            _log_similar_name(name, name, 0)
+            return name, 0
+
+        candidates = self._candidates(name)
+        if len(candidates) == 0:
+            return None, float("inf")
+
+        similar_name, distance, _ = process.extractOne(
+            name, candidates, scorer=fuzz_distance.Levenshtein.distance
+        )
 
-    # Iterate through each string in the array
-    for string in array:
-        # Calculate the Levenshtein distance
-        distance = Levenshtein.distance(target_string, string)
+        _log_similar_name(name, similar_name, distance)
 
-        if distance == 0:
-            LOGGER.log_with_depth(
-                f"Similar Name: {target_string} -> {string}, levenshtein distance: {distance}",
-                depth=2,
+        return similar_name, distance
+
+    def top_k(self, name, k=5):
+        """
+        Return up to k (name, distance) pairs, closest first.
+        """
+        return [
+            (similar_name, distance)
+            for similar_name, distance, _ in process.extract(
+                name,
+                self._candidates(name),
+                scorer=fuzz_distance.Levenshtein.distance,
+                limit=k,
             )
-            return string, 0
+        ]
 
-        # Update minimum distance and string if a new minimum is found
-        if distance < min_distance:
-            min_distance = distance
-            min_string = string
 
-    LOGGER.log_with_depth(
-        f"Similar Name: {target_string} -> {min_string}, levenshtein distance: {min_distance}",
-        depth=2,
-    )
+def normalize_name(name):
+    """
+    Lowercase a name, replace punctuation with spaces and sort its tokens.
+    """
+    name = "".join(char if char.isalnum() else " " for char in name.lower())
+    return " ".join(sorted(name.split()))
 
-    return min_string, min_distance
+
+class AliasIndex:
+    """
+    Resolver of free-text names to a fixed vocabulary of entity names, built once at load time.
+
+    A query is resolved by its normalised form (see `normalize_name`), then by the normalised forms
+    of its synonyms, then by fuzzy matching over the normalised vocabulary. Entity synonyms are
+    indexed as aliases of the entity. With `max_ratio` set, fuzzy matches farther than
+    max_ratio * len(query) are rejected. Resolution outcomes are counted for `stats`.
+    """
+
+    OUTCOMES = ["exact", "normalized", "synonym", "fuzzy", "miss"]
+
+    def __init__(self, names, synonyms=None, max_ratio=None, ngram_size=3):
+        self.synonyms = synonyms or {}
+        self.max_ratio = max_ratio
+
+        self.names = set(names)
+        self.aliases = {}
+        for name in names:
+            self.aliases.setdefault(normalize_name(name), name)
+        # Entity names win over the synonyms of other entities
+        for name in names:
+            for synonym in self.synonyms.get(name, []):
+                self.aliases.setdefault(normalize_name(synonym), name)
+
+        self.matcher = NameMatcher(self.aliases, ngram_size=ngram_size)
+
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(self.OUTCOMES, 0)
+
+    def _count(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def resolve(self, name):
+        """
+        Return the entity name a query refers to, None if it matches none.
+        """
+        name = name.strip().lower()
+        if name in self.names:
+            self._count("exact")
+            return name
+
+        key = normalize_name(name)
+        if key in self.aliases:
+            self._count("normalized")
+            return self.aliases[key]
+
+        for synonym in self.synonyms.get(name, []):
+            synonym_key = normalize_name(synonym)
+            if synonym_key in self.aliases:
+                self._count("synonym")
+                return self.aliases[synonym_key]
+
+        similar_key, distance = self.matcher.match(key)
+        if similar_key is None or (
+            self.max_ratio is not None and distance > self.max_ratio * len(key)
+        ):
+            self._count("miss")
+            return None
+
+        self._count("fuzzy")
+        return self.aliases[similar_key]
+
+    def stats(self):
+        """
+        Return the count of every outcome, the hit rate of the exact, normalized and synonym
+        matches, and the rate of fuzzy matches, which may resolve to the wrong entity.
+        """
+        with self.lock:
+            counts = dict(self.counts)
+
+        total = sum(counts.values())
+        hits = counts["exact"] + counts["normalized"] + counts["synonym"]
+        counts["total"] = total
+        counts["hit_rate"] = hits / total if total > 0 else 0.0
+        counts["fuzzy_rate"] = counts["fuzzy"] / total if total > 0 else 0.0
+
+        return counts
 
 
 def get_drug_synonyms(drug_name):
     drug_name = drug_name.strip().lower()
-    if drug_name in NAME_SYNONYMS:
-        return NAME_SYNONYMS[drug_name]
+    synonyms = name_synonyms()
+    if drug_name in synonyms:
+        return synonyms[drug_name]
     else:
         return [drug_name]
 
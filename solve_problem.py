@@ -1,131 +1,209 @@
+import argparse
+import asyncio
+import json
 import os
 import re
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
 from dotenv import load_dotenv
 from openai import OpenAI
 
 from agents import clinical_agent
-from agents.planning_agent import decomposition
-from core.utils import LOGGER, llm_request
+from agents.planning_agent import adecomposition, decomposition, parse_subproblems
+from core.constants import ExecutionConstants
+from core.resources import warmup
+from core.utils import LLM_CACHE, LOGGER, allm_request, llm_request
 
 client = OpenAI()
 
 sys.path.append(os.getcwd())
 load_dotenv()
 
-
-def solve_problem(user_problem):
-    agent_tools = [
-        {
-            "type": "function",
-            "function": {
-                "name": "safety_agent",
-                "description": "To understand the safety of the drug, including toxicity and side effects, consult the Safety Agent for safety information. Given drug name, return the safety information of the drug, e.g. ADMET, drug introduction, toxicity and side effects etc.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "drug_name": {
-                            "type": "string",
-                            "description": "The drug name",
-                        }
-                    },
-                    "required": ["drug_name"],
+AGENT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "safety_agent",
+            "description": "To understand the safety of the drug, including toxicity and side effects, consult the Safety Agent for safety information. Given drug name, return the safety information of the drug, e.g. ADMET, drug introduction, toxicity and side effects etc.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "drug_name": {
+                        "type": "string",
+                        "description": "The drug name",
+                    }
                 },
+                "required": ["drug_name"],
             },
         },
-        {
-            "type": "function",
-            "function": {
-                "name": "efficiency_agent",
-                "description": "To assess the drug's efficiency against the diseases, ask the efficiency Agent for information regarding the drug's effectiveness on the disease. Given drug name and disease name, return the drug introduction, disease introduction, and the path between drug and disease in the hetionet knowledge graph etc.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "drug_name": {
-                            "type": "string",
-                            "description": "The drug name",
-                        },
-                        "disease_name": {
-                            "type": "string",
-                            "description": "The disease name",
-                        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "efficiency_agent",
+            "description": "To assess the drug's efficiency against the diseases, ask the efficiency Agent for information regarding the drug's effectiveness on the disease. Given drug name and disease name, return the drug introduction, disease introduction, and the path between drug and disease in the hetionet knowledge graph etc.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "drug_name": {
+                        "type": "string",
+                        "description": "The drug name",
+                    },
+                    "disease_name": {
+                        "type": "string",
+                        "description": "The disease name",
                     },
-                    "required": ["drug_name", "disease_name"],
                 },
+                "required": ["drug_name", "disease_name"],
             },
         },
-        {
-            "type": "function",
-            "function": {
-                "name": "enrollment_agent",
-                "description": "To determine if the clinical trial's eligibility criteria facilitate easy enrollment with enough patients. Given eligibility criteria, return the clinical trial will be poor enrollment, good enrollment, or excellent enrollment.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "eligibility_criteria": {
-                            "type": "string",
-                            "description": "eligibility criteria, contains including criteria and excluding criteria",
-                        }
-                    },
-                    "required": ["eligibility_criteria"],
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "enrollment_agent",
+            "description": "To determine if the clinical trial's eligibility criteria facilitate easy enrollment with enough patients. Given eligibility criteria, return the clinical trial will be poor enrollment, good enrollment, or excellent enrollment.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "eligibility_criteria": {
+                        "type": "string",
+                        "description": "eligibility criteria, contains including criteria and excluding criteria",
+                    }
                 },
+                "required": ["eligibility_criteria"],
             },
         },
-        {
-            "type": "function",
-            "function": {
-                "name": "graph_reasoning_agent",
-                "description": "The Graph Reasoning Agent is designed to interpret and respond to requests by analyzing graph structures. The agent loads the specified graph, processes the relationships or paths between the nodes, and delivers a response aligned with the user's instruction. Ideal for tasks involving graph-based data reasoning and exploration.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "keyword_1": {
-                            "type": "string",
-                            "description": "The first keyword indicating a node in the graph",
-                        },
-                        "keyword_2": {
-                            "type": "string",
-                            "description": "The second keyword indicating a node in the graph",
-                        },
-                        "user_instruction": {
-                            "type": "string",
-                            "description": "The request to be answered",
-                        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "graph_reasoning_agent",
+            "description": "The Graph Reasoning Agent is designed to interpret and respond to requests by analyzing graph structures. The agent loads the specified graph, processes the relationships or paths between the nodes, and delivers a response aligned with the user's instruction. Ideal for tasks involving graph-based data reasoning and exploration.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "keyword_1": {
+                        "type": "string",
+                        "description": "The first keyword indicating a node in the graph",
+                    },
+                    "keyword_2": {
+                        "type": "string",
+                        "description": "The second keyword indicating a node in the graph",
+                    },
+                    "user_instruction": {
+                        "type": "string",
+                        "description": "The request to be answered",
                     },
-                    "required": [
-                        "keyword_1",
-                        "keyword_2",
-                        "user_instruction",
-                    ],
                 },
+                "required": [
+                    "keyword_1",
+                    "keyword_2",
+                    "user_instruction",
+                ],
             },
         },
-    ]
-
-    LOGGER.log_with_depth(f"Decomposing the problem...")
-    decomposed_resp = decomposition(user_problem, agent_tools)
+    },
+]
 
-    subproblems = re.findall(r"<subproblem>(.*?)</subproblem>", decomposed_resp)
-    subproblems = [subproblem.strip() for subproblem in subproblems]
 
+def log_subproblems(subproblems):
     for idx, subproblem in enumerate(subproblems):
         LOGGER.log_with_depth(f"[PROBLEM]: {subproblem}")
 
-    problem_results = []
 
-    clinicalAgent = clinical_agent.ClinicalAgent(user_problem)
+def solve_subproblem(user_problem, sub_problem, clinicalAgent=None):
+    # A fresh agent keeps the conversation history of concurrent subproblems apart
+    if clinicalAgent is None:
+        clinicalAgent = clinical_agent.ClinicalAgent(user_problem)
+
+    LOGGER.log_with_depth(f"\t[PROBLEM]: {sub_problem}...")
+    response = clinicalAgent.request(
+        f"The original user problem is: {user_problem}\nNow, solve this problem: {sub_problem}"
+    )
 
-    for sub_problem in subproblems:
-        LOGGER.log_with_depth(f"\t[PROBLEM]: {sub_problem}...")
-        response = clinicalAgent.request(
-            f"The original user problem is: {user_problem}\nNow, solve this problem: {sub_problem}"
+    LOGGER.log_with_depth(f"\t[SOLUTION]: {response}\n")
+    return response
+
+
+def solve_subproblems(
+    user_problem,
+    subproblems,
+    concurrent=False,
+    max_workers=ExecutionConstants.MAX_WORKERS,
+):
+    if not concurrent or len(subproblems) <= 1:
+        # Sequential mode: subproblems share one agent and see earlier answers
+        clinicalAgent = clinical_agent.ClinicalAgent(user_problem)
+        return [
+            solve_subproblem(user_problem, sub_problem, clinicalAgent)
+            for sub_problem in subproblems
+        ]
+
+    # Concurrent mode: map() yields results in the original subproblem order
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(subproblems))) as pool:
+        return list(
+            pool.map(
+                lambda sub_problem: solve_subproblem(user_problem, sub_problem),
+                subproblems,
+            )
         )
 
-        LOGGER.log_with_depth(f"\t[SOLUTION]: {response}\n")
-        problem_results.append(response)
 
+def solve_problem(
+    user_problem, concurrent=False, max_workers=ExecutionConstants.MAX_WORKERS
+):
+    LOGGER.log_with_depth(f"Decomposing the problem...")
+    decomposed_resp = decomposition(user_problem, AGENT_TOOLS)
+    subproblems = parse_subproblems(decomposed_resp)
+    log_subproblems(subproblems)
+
+    problem_results = solve_subproblems(
+        user_problem, subproblems, concurrent=concurrent, max_workers=max_workers
+    )
+
+    final_results = llm_request(build_final_messages(user_problem, problem_results))
+
+    return log_final_results(final_results)
+
+
+async def asolve_subproblem(user_problem, sub_problem):
+    clinicalAgent = clinical_agent.ClinicalAgent(user_problem)
+
+    LOGGER.log_with_depth(f"\t[PROBLEM]: {sub_problem}...")
+    response = await clinicalAgent.arequest(
+        f"The original user problem is: {user_problem}\nNow, solve this problem: {sub_problem}"
+    )
+
+    LOGGER.log_with_depth(f"\t[SOLUTION]: {response}\n")
+    return response
+
+
+async def asolve_problem(user_problem):
+    """
+    Async counterpart of solve_problem, the subproblems are always solved concurrently.
+    """
+    LOGGER.log_with_depth(f"Decomposing the problem...")
+    decomposed_resp = await adecomposition(user_problem, AGENT_TOOLS)
+    subproblems = parse_subproblems(decomposed_resp)
+    log_subproblems(subproblems)
+
+    # gather() keeps the results in the original subproblem order
+    problem_results = await asyncio.gather(
+        *[asolve_subproblem(user_problem, sub_problem) for sub_problem in subproblems]
+    )
+
+    final_results = await allm_request(
+        build_final_messages(user_problem, list(problem_results))
+    )
+
+    return log_final_results(final_results)
+
+
+def build_final_messages(user_problem, problem_results):
     messages = []
     fewshot_examples = open("few_shot.txt", "r").read()
     system_prompt = f""" 
@@ -159,45 +237,260 @@ def solve_problem(user_problem):
         }
     )
 
-    final_results = llm_request(messages)
+    return messages
+
+
+def log_final_results(final_results):
+    content = final_results.choices[0].message.content
+
     LOGGER.log_with_depth(f"Final results:\n")
-    LOGGER.log_with_depth(final_results.choices[0].message.content)
+    LOGGER.log_with_depth(content)
     LOGGER.log_with_depth("\n===============================================\n\n")
 
+    return content
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        LOGGER.log_with_depth("Error: Please provide the random_idx argument.")
-        sys.exit(1)
 
-    LOGGER.log_with_depth(f"Random Index: {sys.argv[1]}")
-    random_idx = int(sys.argv[1])
+def build_user_problem(trial_row):
+    return f"""
+        I have designed a clinical trial and hope you can help me predict whether this trial can pass.
+        #criteria#: {trial_row["criteria"]}
+        #drugs#: {trial_row["drugs"]}
+        #diseases#: {trial_row["diseases"]}
+        """
+
 
+def parse_final_result(content):
+    match = re.search(r"<final_result>\s*([-+]?\d*\.?\d+)\s*</final_result>", content)
+    if match is None:
+        return None
+    return float(match.group(1))
+
+
+def load_trials(nctids=None, row_range=None):
     cwd_path = os.getcwd()
     trial_df = pd.read_csv(
         f"{cwd_path}/agents/tools/risk_model/data/trial_success.csv", sep="\t"
     )
+
+    if row_range is not None:
+        trial_df = trial_df.iloc[row_range[0] : row_range[1]]
+    if nctids:
+        trial_df = trial_df[trial_df["nctid"].isin(nctids)]
+
+    return trial_df
+
+
+def load_scored_nctids(output_path):
+    """
+    Return the nctids already scored successfully in a previous run, so they can be skipped.
+    """
+    scored_nctids = set()
+
+    if not os.path.exists(output_path):
+        return scored_nctids
+
+    with open(output_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written line of an interrupted run
+                continue
+
+            if record.get("error") is None:
+                scored_nctids.add(record["nctid"])
+
+    return scored_nctids
+
+
+def _trial_record(trial_row, start_time, content=None, error=None):
+    return {
+        "nctid": trial_row["nctid"],
+        "prediction": None if content is None else parse_final_result(content),
+        "label": int(trial_row["label"]),
+        "latency": round(time.perf_counter() - start_time, 3),
+        "error": None if error is None else str(error),
+    }
+
+
+def score_trial(trial_row, concurrent=False):
+    start_time = time.perf_counter()
+    try:
+        content = solve_problem(build_user_problem(trial_row), concurrent=concurrent)
+    except Exception as e:
+        LOGGER.log_with_depth(f"Error: {trial_row['nctid']}: {e}")
+        return _trial_record(trial_row, start_time, error=e)
+
+    return _trial_record(trial_row, start_time, content=content)
+
+
+async def ascore_trial(trial_row):
+    start_time = time.perf_counter()
+    try:
+        content = await asolve_problem(build_user_problem(trial_row))
+    except Exception as e:
+        LOGGER.log_with_depth(f"Error: {trial_row['nctid']}: {e}")
+        return _trial_record(trial_row, start_time, error=e)
+
+    return _trial_record(trial_row, start_time, content=content)
+
+
+def _pending_trials(trial_df, output_path):
+    scored_nctids = load_scored_nctids(output_path)
+    pending_df = trial_df[~trial_df["nctid"].isin(scored_nctids)]
+
+    LOGGER.log_with_depth(
+        f"Scoring {len(pending_df)} trials, {len(trial_df) - len(pending_df)} already scored in {output_path}"
+    )
+
+    return [trial_row for _, trial_row in pending_df.iterrows()]
+
+
+def score_trials(
+    trial_df,
+    output_path,
+    max_workers=ExecutionConstants.MAX_WORKERS,
+    concurrent=False,
+):
+    """
+    Score every trial of trial_df on a thread pool, appending one JSON line per trial to output_path.
+
+    Trials already scored successfully in output_path are skipped, so an interrupted run can be resumed.
+    """
+    trial_rows = _pending_trials(trial_df, output_path)
+
+    with open(output_path, "a") as f, ThreadPoolExecutor(max_workers) as pool:
+        futures = [
+            pool.submit(score_trial, trial_row, concurrent) for trial_row in trial_rows
+        ]
+
+        # Records are written by this thread only, in completion order
+        for future in as_completed(futures):
+            f.write(json.dumps(future.result()) + "\n")
+            f.flush()
+
+
+async def ascore_trials(
+    trial_df, output_path, max_workers=ExecutionConstants.MAX_WORKERS
+):
+    """
+    Async counterpart of score_trials, at most max_workers trials are in flight at once.
+    """
+    trial_rows = _pending_trials(trial_df, output_path)
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def bounded_score_trial(trial_row):
+        async with semaphore:
+            return await ascore_trial(trial_row)
+
+    with open(output_path, "a") as f:
+        for coro in asyncio.as_completed(
+            [bounded_score_trial(trial_row) for trial_row in trial_rows]
+        ):
+            f.write(json.dumps(await coro) + "\n")
+            f.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Predict whether clinical trials from trial_success.csv can pass."
+    )
+    parser.add_argument(
+        "random_idx", nargs="?", type=int, help="Row index of a single trial to solve"
+    )
+    parser.add_argument("--nctids", nargs="+", help="NCT IDs of the trials to score")
+    parser.add_argument(
+        "--range",
+        dest="row_range",
+        type=lambda value: tuple(int(v) for v in value.split(":")),
+        help="Half-open row range START:END of the trials to score",
+    )
+    parser.add_argument(
+        "--output",
+        default="trial_scores.jsonl",
+        help="JSONL file the batch results are appended to",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=ExecutionConstants.MAX_WORKERS,
+        help="Number of trials scored at the same time in batch mode",
+    )
+    parser.add_argument(
+        "--concurrent",
+        action="store_true",
+        help="Solve the subproblems of a trial concurrently",
+    )
+    parser.add_argument(
+        "--warmup",
+        action="store_true",
+        help="Load every model, table and graph before solving",
+    )
+    parser.add_argument(
+        "--precompute-plans",
+        action="store_true",
+        help="Decompose the specialist questions once before scoring",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run the pipeline on the async OpenAI client",
+    )
+
+    args = parser.parse_args()
+    if args.random_idx is None and args.nctids is None and args.row_range is None:
+        parser.error("Please provide the random_idx argument, --nctids or --range.")
+
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.warmup:
+        LOGGER.log_with_depth(f"Warmed up: {warmup()}")
+    if args.precompute_plans:
+        clinical_agent.precompute_plans()
+
+    if args.random_idx is None:
+        # Batch mode: models and tables are loaded once for every trial
+        trial_df = load_trials(args.nctids, args.row_range)
+
+        if args.use_async:
+            asyncio.run(ascore_trials(trial_df, args.output, args.workers))
+        else:
+            score_trials(
+                trial_df, args.output, args.workers, concurrent=args.concurrent
+            )
+
+        if LLM_CACHE is not None:
+            LOGGER.log_with_depth(f"LLM cache: {LLM_CACHE.stats()}")
+        sys.exit(0)
+
+    LOGGER.log_with_depth(f"Random Index: {args.random_idx}")
+    random_idx = args.random_idx
+
+    trial_df = load_trials()
     trial_row = trial_df.iloc[random_idx]
 
     try:
         nctid = trial_row["nctid"]
-        criteria = trial_row["criteria"]
-        drugs = trial_row["drugs"]
-        diseases = trial_row["diseases"]
         label = trial_row["label"]
 
-        user_problem = f"""
-        I have designed a clinical trial and hope you can help me predict whether this trial can pass.
-        #criteria#: {criteria}
-        #drugs#: {drugs}
-        #diseases#: {diseases}
-        """
+        user_problem = build_user_problem(trial_row)
 
         LOGGER.log_with_depth(
             f"NCTID: {nctid}\nUser problem:\n {user_problem}\n\n Correct Label: {label}, 1 means passed, 0 means not passed.\n"
         )
 
-        solve_problem(user_problem)
+        if args.use_async:
+            asyncio.run(asolve_problem(user_problem))
+        else:
+            solve_problem(user_problem, concurrent=args.concurrent)
+
+        if LLM_CACHE is not None:
+            LOGGER.log_with_depth(f"LLM cache: {LLM_CACHE.stats()}")
 
         LOGGER.log_with_depth("\n\n\n\n\n\n\n\n")
     except Exception as e: